@@ -0,0 +1,230 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# Micro-benchmarks for the event pipeline and the drawing code in main.py. Events are generated synthetically, for
+# as many calendars and events as needed, so no Google account or display is involved.
+#
+# Each stage reports its best time out of several runs and the memory it allocates. Run with --update-baseline on
+# the machine you care about (for example the Pi Zero) to save the results, then later runs fail when a stage got
+# slower or allocates more than the baseline allows.
+import argparse
+import json
+import logging
+import os
+import random
+import time
+import tracemalloc
+
+from datetime import datetime, timedelta
+
+import main
+from PIL import ImageDraw
+from eventindex import EventIndex
+from fileepd import FileEPD
+from framebuffer import newPanelImage, packPanelBuffer, renderPanelBands
+
+defaultBaselineFile = os.path.join(main.resdir, "benchmark-baseline.json")
+
+# The footer font of main.py, Font.ttc, is not in resources/. FreeSans.ttf is, and keeps the results the same on
+# every machine
+main.updatedFont = ("FreeSans.ttf", main.updatedFont[1])
+
+summaryWords = ["Team", "standup", "Dentist", "appointment", "Soccer", "practice", "Lunch", "with", "Larry",
+                "Linder", "Quarterly", "planning", "review", "School", "holiday", "Piano", "lesson", "Pick", "up",
+                "groceries", "Conference", "call", "Design", "session", "at", "pub"]
+
+
+# Generates eventCount events spread over calendarCount calendars and the next dayCount days. About one in eight
+# events is an all day event. The same seed always gives the same events.
+def generateSyntheticEvents(calendarCount, eventCount, dayCount=10, seed=1):
+    rng = random.Random(seed)
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    calendarNames = [f"CALENDAR-{i}" for i in range(calendarCount)]
+
+    piEvents = []
+    for i in range(eventCount):
+        calendarName = calendarNames[i % calendarCount]
+        summary = " ".join(rng.choice(summaryWords) for _ in range(rng.randint(1, 7)))
+        day = rng.randrange(dayCount)
+
+        if rng.random() < 0.125:
+            piEvents.append(main.PiCalendarEvent(calendarName=calendarName,
+                                                 eventSummary=summary,
+                                                 allDayEventDate=(today + timedelta(days=day)).date(),
+                                                 eventStartTime=None,
+                                                 eventEndTime=None))
+        else:
+            eventStart = today + timedelta(days=day, minutes=rng.randrange(0, 24 * 60, 15))
+            piEvents.append(main.PiCalendarEvent(calendarName=calendarName,
+                                                 eventSummary=summary,
+                                                 allDayEventDate=None,
+                                                 eventStartTime=eventStart,
+                                                 eventEndTime=eventStart + timedelta(minutes=rng.choice([30, 60, 90]))))
+
+    return piEvents
+
+# The stages to measure, as (name, function that runs the stage once, number of operations in one run)
+def getStages(piEvents):
+    sortedEvents = main.sortEvents(piEvents)
+    summaries = [event.eventSummary for event in piEvents]
+    startTimes = [event.eventStartTime for event in piEvents if event.eventStartTime is not None]
+
+    panelImage = newPanelImage((480, 800))
+    main.drawEvents(ImageDraw.Draw(panelImage), sortedEvents, main.originX, main.originY)
+    rgbImage = panelImage.convert("RGB")
+    fileDisplay = FileEPD(os.path.join(main.resdir, main.fileDisplayDir), latencyScale=0)
+
+    # One sorted stream per calendar, like the Calendar API returns them
+    calendarEvents = {}
+    for event in sortedEvents:
+        calendarEvents.setdefault(event.calendarName, []).append(event)
+    eventStreams = list(calendarEvents.values())
+
+    eventIndex = EventIndex(piEvents)
+    today = datetime.now().date()
+    days = [today + timedelta(days=i) for i in range(main.displayDays)]
+    monthEnd = today + timedelta(days=30)
+
+    def queryDays():
+        for day in days:
+            eventIndex.eventsOnDay(day)
+
+    def sortKeys():
+        for event in piEvents:
+            event.get_sort_key()
+
+    def splitSummaries():
+        for summary in summaries:
+            main.maybeSplitEventSummary(summary)
+
+    def formatTimes():
+        for startTime in startTimes:
+            main.formatEventDateTime(startTime)
+
+    def drawPanelColors():
+        main.drawEvents(ImageDraw.Draw(newPanelImage((480, 800))), sortedEvents, main.originX, main.originY)
+
+    # Draws and packs the same frame as drawEvents and packPanelBuffer together, the way lowMemoryMode does
+    displayList = main.layoutEvents(sortedEvents, main.originX, main.originY)
+    def drawPanelBands():
+        renderPanelBands((480, 800), 800, 480, main.renderBandRows,
+                         lambda image, left, top: main.drawPanelBand(image, left, top, displayList))
+
+    return [
+        ("get_sort_key", sortKeys, len(piEvents)),
+        ("sortEvents", lambda: main.sortEvents(piEvents), 1),
+        ("EventIndex", lambda: EventIndex(piEvents), 1),
+        ("eventsOnDay", queryDays, len(days)),
+        ("eventsBetween (month)", lambda: eventIndex.eventsBetween(today, monthEnd), 1),
+        ("mergeEventStreams", lambda: list(main.mergeEventStreams(eventStreams)), 1),
+        ("layoutEvents (merged)", lambda: main.layoutEvents(main.mergeEventStreams(eventStreams), main.originX,
+                                                            main.originY), 1),
+        ("maybeSplitEventSummary", splitSummaries, len(summaries)),
+        ("formatEventDateTime", formatTimes, len(startTimes)),
+        ("drawEvents", drawPanelColors, 1),
+        ("packPanelBuffer", lambda: packPanelBuffer(panelImage, 800, 480), 1),
+        ("getbuffer (RGB)", lambda: fileDisplay.getbuffer(rgbImage), 1),
+        ("renderPanelBands", drawPanelBands, 1),
+    ]
+
+# Checks that the index gives the same events as scanning all of them, for every day and for the whole range
+def checkEventIndex(piEvents):
+    eventIndex = EventIndex(piEvents)
+    sortedEvents = main.sortEvents(piEvents)
+    today = datetime.now().date()
+    days = [today + timedelta(days=i) for i in range(-1, 12)]
+
+    for day in days:
+        if eventIndex.eventsOnDay(day) != [event for event in sortedEvents if event.getDate() == day]:
+            print(f"EventIndex.eventsOnDay({day}) does not match a scan of the events")
+            exit(1)
+
+    firstDay, lastDay = days[2], days[-3]
+    if eventIndex.eventsBetween(firstDay, lastDay) != [event for event in sortedEvents
+                                                       if firstDay <= event.getDate() <= lastDay]:
+        print(f"EventIndex.eventsBetween({firstDay}, {lastDay}) does not match a scan of the events")
+        exit(1)
+
+# Runs a stage repeat times and returns the best time per operation in microseconds
+def timeStage(stage, operations, repeat):
+    bestSeconds = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        stage()
+        elapsed = time.perf_counter() - start
+        if bestSeconds is None or elapsed < bestSeconds:
+            bestSeconds = elapsed
+
+    return bestSeconds * 1000000 / operations
+
+# Runs a stage once under tracemalloc and returns the peak memory it allocated in KB
+def measureAllocations(stage):
+    tracemalloc.start()
+    try:
+        stage()
+        currentBytes, peakBytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return peakBytes / 1024
+
+def runBenchmarks():
+    parser = argparse.ArgumentParser(description="Benchmarks the event pipeline and drawing code of main.py")
+    parser.add_argument("--calendars", type=int, default=200, help="number of synthetic calendars")
+    parser.add_argument("--events", type=int, default=20000, help="number of synthetic events")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per stage, the best run counts")
+    parser.add_argument("--baseline", default=defaultBaselineFile, help="baseline file to compare against")
+    parser.add_argument("--update-baseline", action="store_true", help="save the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed slowdown or extra allocation compared to the baseline, 0.25 = 25%%")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    piEvents = generateSyntheticEvents(args.calendars, args.events)
+    print(f"{len(piEvents)} events in {args.calendars} calendars\n")
+    checkEventIndex(piEvents)
+
+    baseline = {}
+    if not args.update_baseline and os.path.exists(args.baseline):
+        with open(args.baseline, "r") as baselineFile:
+            baseline = json.load(baselineFile)
+
+        if baseline.get("calendars") != args.calendars or baseline.get("events") != args.events:
+            print(f"The baseline was made with {baseline.get('events')} events in {baseline.get('calendars')} calendars, "
+                  "results are not compared\n")
+            baseline = {}
+
+    results = {}
+    regressions = []
+    print(f"{'stage':26} {'us/op':>12} {'peak KB':>10}")
+    for name, stage, operations in getStages(piEvents):
+        stageResult = {"usPerOp": timeStage(stage, operations, args.repeat), "peakKb": measureAllocations(stage)}
+        results[name] = stageResult
+
+        line = f"{name:26} {stageResult['usPerOp']:12.3f} {stageResult['peakKb']:10.1f}"
+        baselineResult = baseline.get("stages", {}).get(name)
+        if baselineResult:
+            for metric in ("usPerOp", "peakKb"):
+                # Tiny allocations jump around too much to compare, so anything under 1 KB passes
+                if metric == "peakKb" and stageResult[metric] < 1:
+                    continue
+                if stageResult[metric] > baselineResult[metric] * (1 + args.tolerance):
+                    regressions.append(f"{name}: {metric} {stageResult[metric]:.3f} > baseline {baselineResult[metric]:.3f}")
+                    line += f"  REGRESSED ({metric})"
+        print(line)
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as baselineFile:
+            json.dump({"calendars": args.calendars, "events": args.events, "stages": results}, baselineFile, indent=2)
+        print(f"\nBaseline saved to {args.baseline}")
+    elif not os.path.exists(args.baseline):
+        print(f"\nNo baseline found at {args.baseline}, run with --update-baseline to create one")
+
+    if regressions:
+        print("\nRegressions:")
+        for regression in regressions:
+            print(f"  {regression}")
+        exit(1)
+
+if __name__ == "__main__":
+    runBenchmarks()
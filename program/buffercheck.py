@@ -0,0 +1,71 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# Checks packPanelBuffer in framebuffer.py against getbuffer of the Waveshare driver, without a panel. The driver is
+# loaded with the stand-in epdconfig of transfercheck.py, and the same frame of fake events is packed both ways.
+#
+# - A frame drawn in panel colors, the way main.py draws it, must give the same bytes either way.
+# - A frame with anti-aliased text and colors that are not in the panel palette, the way main.py draws it with
+#   renderPanelColors = False, is dithered by getbuffer. Packed after the same quantize step it must give the same
+#   bytes as well. Drawn in panel colors instead it does not, which the check reports.
+import importlib.util
+
+from PIL import Image, ImageDraw
+
+import main
+from framebuffer import newPanelImage, packPanelBuffer
+from transfercheck import StandInPanel, loadDriver
+
+# The footer font of main.py, Font.ttc, is not in resources/
+main.updatedFont = ("FreeSans.ttf", main.updatedFont[1])
+
+
+# Draws the frame of the fake events, in panel colors or in RGB. Returns the image
+def drawFrame(epd, panelColors):
+    main.renderPanelColors = panelColors
+    displayList = main.layoutEvents(main.sortEvents(main.generateFakeEvents()), main.originX, main.originY)
+    if panelColors:
+        image = newPanelImage((epd.height, epd.width))
+    else:
+        image = Image.new("RGB", (epd.height, epd.width), epd.WHITE)
+    main.drawDisplayList(ImageDraw.Draw(image), displayList + main.layoutFooter(main.originX), main.drawText,
+                         main.getInk, main.getFont)
+    return image
+
+def countDifferentBytes(first, second):
+    return sum(1 for firstByte, secondByte in zip(first, second) if firstByte != secondByte)
+
+def runCheck():
+    if importlib.util.find_spec("waveshare_epd") is None:
+        print(f"The Waveshare driver was not found in {main.libdir}")
+        exit(1)
+
+    epd7in3f = loadDriver(StandInPanel(0).makeEpdConfig("poll"))
+    epd = epd7in3f.EPD()
+    failed = False
+
+    panelImage = drawFrame(epd, True)
+    driverBuffer = bytes(epd.getbuffer(panelImage.convert("RGB")))
+    panelBuffer = bytes(packPanelBuffer(panelImage, epd.width, epd.height))
+    same = panelBuffer == driverBuffer
+    failed = failed or not same
+    print(f"frame in panel colors: {'same' if same else 'DIFFERENT'}")
+
+    rgbImage = drawFrame(epd, False)
+    colorCount = len(rgbImage.getcolors(1 << 24))
+    driverBuffer = bytes(epd.getbuffer(rgbImage))
+    # Dithering spreads the error along the rows, so the frame is turned to the panel's landscape rows first, like
+    # getbuffer does
+    quantizedImage = rgbImage.rotate(90, expand=True).quantize(palette=newPanelImage((1, 1)))
+    packedBuffer = bytes(packPanelBuffer(quantizedImage, epd.width, epd.height))
+    same = packedBuffer == driverBuffer
+    failed = failed or not same
+    print(f"RGB frame with {colorCount} colors, quantized first: {'same' if same else 'DIFFERENT'}")
+    print(f"RGB frame against the frame in panel colors: {countDifferentBytes(panelBuffer, driverBuffer)} of "
+          f"{len(driverBuffer)} bytes differ, the driver dithers the anti-aliased edges of the text")
+
+    if failed:
+        print("\npackPanelBuffer gave different bytes than the driver's getbuffer")
+        exit(1)
+
+if __name__ == "__main__":
+    runCheck()
@@ -0,0 +1,145 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+import json
+import logging
+import random
+import time
+
+from urllib.parse import quote
+
+
+# A small client for the only two Calendar API endpoints main.py uses, calendarList.list and events.list. It is a
+# lighter alternative to the googleapiclient discovery service: no discovery document, no httplib2, and every
+# request goes over one pooled keep-alive HTTPS session. Responses are requested gzipped, and requests that fail
+# with a rate limit, a server error or a dropped connection are retried with exponential backoff.
+#
+# SlimCalendarService can be used in place of build("calendar", "v3"):
+#     service.calendarList().list().execute()
+#     service.events().list(calendarId=..., timeMin=...).execute()
+#
+# All requests go through a transport object, so the client can be pointed at a stand-in server or a fake transport.
+
+defaultBaseUrl = "https://www.googleapis.com/calendar/v3"
+
+# Status codes that are worth trying again
+retryStatuses = (429, 500, 502, 503, 504)
+
+# Google reports some rate limits as 403 with one of these reasons
+retryReasons = ("rateLimitExceeded", "userRateLimitExceeded")
+
+
+# Raised when the Calendar API answers with an error status. Like googleapiclient's HttpError, the status code is
+# available as error.resp.status.
+class CalendarApiError(Exception):
+    def __init__(self, status, reason, content):
+        super().__init__(f"HTTP {status}: {reason}")
+        self.status = status
+        self.reason = reason
+        self.content = content
+        self.resp = self
+
+# Sends requests through a requests.Session. Pass a google.auth.transport.requests.AuthorizedSession to add the
+# OAuth token to every request and refresh it when it expires, or a plain requests.Session for a local stand-in
+# server. The session keeps its connections open between requests.
+class SessionTransport():
+    def __init__(self, session, timeoutSeconds=20):
+        self.session = session
+        self.timeoutSeconds = timeoutSeconds
+
+    # Returns (status, headers, body bytes). The body is already decompressed
+    def request(self, method, url, params, headers):
+        response = self.session.request(method, url, params=params, headers=headers, timeout=self.timeoutSeconds)
+        return response.status_code, response.headers, response.content
+
+class SlimCalendarService():
+    def __init__(self, transport, baseUrl=defaultBaseUrl, maxRetries=4, onResponse=None):
+        self.transport = transport
+        self.baseUrl = baseUrl.rstrip("/")
+        self.maxRetries = maxRetries
+        # Called with the size of every response body, for example to count the bytes received
+        self.onResponse = onResponse
+
+    def calendarList(self):
+        return SlimResource(self, lambda params: "/users/me/calendarList")
+
+    def events(self):
+        return SlimResource(self, lambda params: f"/calendars/{quotePath(params.pop('calendarId'))}/events")
+
+    def get(self, path, params):
+        url = self.baseUrl + path
+        headers = {"Accept": "application/json", "Accept-Encoding": "gzip", "User-Agent": "pi-calendar (gzip)"}
+
+        attempt = 0
+        while True:
+            try:
+                status, responseHeaders, body = self.transport.request("GET", url, params, headers)
+            except OSError as error:
+                # requests exceptions are OSErrors too
+                if attempt >= self.maxRetries:
+                    raise
+                delay = self.getBackoff(attempt)
+                logging.info(f"Request to {path} failed ({error}), trying again in {delay:.1f}s")
+            else:
+                if self.onResponse is not None:
+                    self.onResponse(len(body))
+
+                if status < 400:
+                    return json.loads(body)
+
+                reason = getErrorReason(body)
+                if attempt >= self.maxRetries or not (status in retryStatuses or reason in retryReasons):
+                    raise CalendarApiError(status, reason, body)
+
+                delay = self.getBackoff(attempt, responseHeaders.get("Retry-After"))
+                logging.info(f"Request to {path} returned {status} {reason}, trying again in {delay:.1f}s")
+
+            time.sleep(delay)
+            attempt += 1
+
+    # Exponential backoff with jitter: about 0.5s, 1s, 2s, 4s... unless the server said how long to wait
+    def getBackoff(self, attempt, retryAfter=None):
+        if retryAfter:
+            try:
+                return float(retryAfter)
+            except ValueError:
+                pass
+        return 0.5 * (2 ** attempt) + random.uniform(0, 0.25)
+
+# Mimics a discovery resource, so resource.list(**params).execute() works the same way
+class SlimResource():
+    def __init__(self, service, getPath):
+        self.service = service
+        self.getPath = getPath
+
+    def list(self, **params):
+        return SlimRequest(self.service, self.getPath, params)
+
+class SlimRequest():
+    def __init__(self, service, getPath, params):
+        self.service = service
+        self.getPath = getPath
+        self.params = params
+
+    # http is accepted for compatibility with googleapiclient and ignored, the service has its own session
+    def execute(self, http=None):
+        params = {}
+        for name, value in self.params.items():
+            if isinstance(value, bool):
+                value = "true" if value else "false"
+            params[name] = value
+
+        path = self.getPath(params)
+        return self.service.get(path, params)
+
+
+def quotePath(value):
+    return quote(value, safe="")
+
+# Pulls the reason out of a Google API error body, e.g. "rateLimitExceeded". Falls back to the message
+def getErrorReason(body):
+    try:
+        error = json.loads(body)["error"]
+        errors = error.get("errors") or [{}]
+        return errors[0].get("reason") or error.get("status") or error.get("message", "")
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return ""
@@ -0,0 +1,135 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+import functools
+import hashlib
+
+from collections import namedtuple
+
+
+# A display list describes a frame as a tuple of positioned primitives, before any pixels are drawn. Layout code
+# decides where everything goes and builds the list; drawDisplayList then draws it in one tight loop. Display lists
+# are plain tuples of tuples, so they can be hashed and compared: when the list has not changed, the frame has not
+# changed either, and there is no need to draw it to find out.
+
+# Text at (x, y) in a font spec from main.py. Text with cached=False skips the text sprite cache, for text that is
+# different on every run.
+TextItem = namedtuple("TextItem", ["x", "y", "text", "font", "color", "cached"], defaults=[True])
+
+# Straight line from (x1, y1) to (x2, y2)
+LineItem = namedtuple("LineItem", ["x1", "y1", "x2", "y2", "width", "color"])
+
+# Filled rectangle with rounded corners
+BoxItem = namedtuple("BoxItem", ["x1", "y1", "x2", "y2", "radius", "color"])
+
+
+# Draws every primitive of the display list. drawText(draw, xy, text, font, color) draws cached text, getInk(draw,
+# color) turns a color into the value to draw with and getFont(font) loads a font.
+def drawDisplayList(draw, displayList, drawText, getInk, getFont):
+    for item in displayList:
+        if type(item) is TextItem:
+            if item.cached:
+                drawText(draw, (item.x, item.y), item.text, item.font, item.color)
+            else:
+                draw.text((item.x, item.y), item.text, font=getFont(item.font), fill=getInk(draw, item.color))
+        elif type(item) is BoxItem:
+            ink = getInk(draw, item.color)
+            draw.rounded_rectangle((item.x1, item.y1, item.x2, item.y2), fill=ink, outline=ink, width=2,
+                                   radius=item.radius)
+        elif type(item) is LineItem:
+            draw.line((item.x1, item.y1, item.x2, item.y2), width=item.width, fill=getInk(draw, item.color))
+
+# Returns the primitives of a display list that reach into the rectangle from (left, top) to (right, bottom), moved
+# so the rectangle starts at (0, 0). Used to draw a frame one band at a time. getTextBounds(item) returns a box that
+# holds every pixel a TextItem can draw.
+def clipDisplayList(displayList, left, top, right, bottom, getTextBounds):
+    bandItems = []
+    for item in displayList:
+        if type(item) is TextItem:
+            x1, y1, x2, y2 = getTextBounds(item)
+            if x1 < right and x2 > left and y1 < bottom and y2 > top:
+                bandItems.append(item._replace(x=item.x - left, y=item.y - top))
+        else:
+            # Boxes and lines, with room for the outline and the line width
+            margin = item.width if type(item) is LineItem else 1
+            if (min(item.x1, item.x2) - margin < right and max(item.x1, item.x2) + margin >= left and
+                    min(item.y1, item.y2) - margin < bottom and max(item.y1, item.y2) + margin >= top):
+                bandItems.append(item._replace(x1=item.x1 - left, y1=item.y1 - top, x2=item.x2 - left,
+                                               y2=item.y2 - top))
+
+    return bandItems
+
+# Returns a fingerprint of a display list that stays the same between runs
+def getDisplayListFingerprint(displayList):
+    return hashlib.sha256(repr(displayList).encode("utf-8")).hexdigest()
+
+# Compares two display lists. Returns the primitives that are only in the old list and the ones only in the new list.
+def diffDisplayLists(oldList, newList):
+    oldItems = set(oldList)
+    newItems = set(newList)
+    return [item for item in oldList if item not in newItems], [item for item in newList if item not in oldItems]
+
+
+# Measures and wraps text using the advance widths of the real glyphs, so text is broken where it actually runs out
+# of room instead of after a fixed number of characters. Word widths are memoized, since event summaries repeat
+# the same words over and over.
+class TextMeasurer():
+    ellipsis = "…"
+
+    def __init__(self, getFont):
+        self.getFont = getFont
+        self.getWordWidth = functools.lru_cache(maxsize=4096)(self.measureWord)
+
+    def measureWord(self, fontSpec, word):
+        return self.getFont(fontSpec).getlength(word)
+
+    def getTextWidth(self, fontSpec, text):
+        words = text.split(" ")
+        width = sum(self.getWordWidth(fontSpec, word) for word in words)
+        return width + (len(words) - 1) * self.getWordWidth(fontSpec, " ")
+
+    # Breaks text into at most maxLines lines that are each at most maxWidth pixels wide. Text that does not fit in
+    # maxLines lines ends with an ellipsis. A single word that is wider than a whole line is cut with an ellipsis too.
+    def wrapText(self, fontSpec, text, maxWidth, maxLines):
+        spaceWidth = self.getWordWidth(fontSpec, " ")
+        lines = []
+        lineWidths = []
+        line = []
+        lineWidth = 0
+
+        for word in text.split():
+            wordWidth = self.getWordWidth(fontSpec, word)
+            if line and lineWidth + spaceWidth + wordWidth > maxWidth:
+                lines.append(" ".join(line))
+                lineWidths.append(lineWidth)
+                line = []
+                lineWidth = 0
+
+            if line:
+                lineWidth += spaceWidth
+            line.append(word)
+            lineWidth += wordWidth
+
+        if line:
+            lines.append(" ".join(line))
+            lineWidths.append(lineWidth)
+
+        overflow = len(lines) > maxLines
+        lines = lines[:maxLines]
+        for i, line in enumerate(lines):
+            lastLine = i == len(lines) - 1
+            if lineWidths[i] > maxWidth or (lastLine and overflow):
+                lines[i] = self.truncateText(fontSpec, line, maxWidth)
+
+        return lines
+
+    # Shortens text until it fits in maxWidth pixels with an ellipsis at the end. Adds up the memoized width of each
+    # character instead of measuring every shorter version of the text.
+    def truncateText(self, fontSpec, text, maxWidth):
+        availableWidth = maxWidth - self.getWordWidth(fontSpec, self.ellipsis)
+        width = 0
+        for i, character in enumerate(text):
+            width += self.getWordWidth(fontSpec, character)
+            if width > availableWidth:
+                return text[:i].rstrip() + self.ellipsis
+
+        return text.rstrip() + self.ellipsis
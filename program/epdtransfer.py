@@ -0,0 +1,69 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+import logging
+import time
+
+
+# Waits for the BUSY pin of the 7.3 inch panel without keeping the CPU busy. The Waveshare driver reads the pin every
+# 5 ms for the whole 30 s refresh; on a single core Pi Zero that takes CPU away from everything else. FastEPD sleeps
+# until the pin changes instead, through gpiozero or RPi.GPIO edge detection. Drivers without either are still
+# polled, just less often. Everything else, including sending the frame, is left to the driver.
+#
+# FastEPD wraps an epd7in3f.EPD; everything it does not change is passed on to the driver. epdconfig is the driver's
+# epdconfig module.
+class FastEPD():
+    # Longest time the panel may stay busy before giving up, in seconds. A refresh takes about 30
+    busyTimeoutSeconds = 90
+
+    # RPi.GPIO edge waits are cut into slices of this many ms, so a change just before the wait is not missed
+    edgeSliceMs = 200
+
+    # Poll interval when the driver offers no edge detection, in ms
+    pollMs = 20
+
+    def __init__(self, epd, epdconfig):
+        self.epd = epd
+        self.epdconfig = epdconfig
+
+        # The driver's init and TurnOnDisplay call ReadBusyH, so they wait through waitWhileBusy
+        epd.ReadBusyH = self.waitWhileBusy
+
+    def __getattr__(self, name):
+        return getattr(self.epd, name)
+
+    # Returns when the BUSY pin goes high (idle). Raises TimeoutError when the panel stays busy too long
+    def waitWhileBusy(self):
+        logging.debug("e-Paper busy H")
+        busyPin = getattr(self.epdconfig, "GPIO_BUSY_PIN", None)
+        gpio = getattr(self.epdconfig, "GPIO", None)
+
+        if busyPin is not None and hasattr(busyPin, "wait_for_press"):
+            # gpiozero sets up BUSY as a button that is pressed while the pin is high
+            if not busyPin.wait_for_press(timeout=self.busyTimeoutSeconds):
+                raise TimeoutError(f"e-Paper still busy after {self.busyTimeoutSeconds} seconds")
+        elif gpio is not None and hasattr(gpio, "wait_for_edge"):
+            self.waitForEdge(gpio)
+        else:
+            self.pollBusy()
+
+        logging.debug("e-Paper busy H release")
+
+    def waitForEdge(self, gpio):
+        deadline = time.monotonic() + self.busyTimeoutSeconds
+        while self.epdconfig.digital_read(self.epd.busy_pin) == 0:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"e-Paper still busy after {self.busyTimeoutSeconds} seconds")
+            try:
+                gpio.wait_for_edge(self.epd.busy_pin, gpio.RISING, timeout=self.edgeSliceMs)
+            except RuntimeError:
+                # Edge detection is already in use on the pin
+                self.pollBusy(deadline)
+                return
+
+    def pollBusy(self, deadline=None):
+        if deadline is None:
+            deadline = time.monotonic() + self.busyTimeoutSeconds
+        while self.epdconfig.digital_read(self.epd.busy_pin) == 0:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"e-Paper still busy after {self.busyTimeoutSeconds} seconds")
+            self.epdconfig.delay_ms(self.pollMs)
@@ -0,0 +1,45 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+import bisect
+import operator
+
+from array import array
+from datetime import date
+
+getSortKey = operator.attrgetter("sortKey")
+
+# Keeps PiCalendarEvents sorted by their sort key, with the day of every event in a compact array next to them.
+# "Events on day D" and "events from day D1 to day D2" are two binary searches, so asking for a few days costs the
+# same with ten events or with ten thousand, which is what views of two weeks or a month need. Iterating over the
+# index gives the events in the order of sortEvents, so an index can be passed straight to layoutEvents or
+# mergeEventStreams.
+class EventIndex():
+    def __init__(self, piEvents=()):
+        self.events = sorted(piEvents, key=getSortKey)
+        self.dayOrdinals = array("l", (event.dayOrdinal for event in self.events))
+
+    def __len__(self):
+        return len(self.events)
+
+    def __iter__(self):
+        return iter(self.events)
+
+    # Adds one event, keeping the index sorted. Events with the same sort key stay in the order they were added
+    def add(self, piEvent):
+        position = bisect.bisect_right(self.events, piEvent.sortKey, key=getSortKey)
+        self.events.insert(position, piEvent)
+        self.dayOrdinals.insert(position, piEvent.dayOrdinal)
+
+    # Returns the events on one day, in sort order. day is a date
+    def eventsOnDay(self, day):
+        return self.eventsBetween(day, day)
+
+    # Returns the events from firstDay up to and including lastDay, in sort order. Both are dates
+    def eventsBetween(self, firstDay, lastDay):
+        start = bisect.bisect_left(self.dayOrdinals, firstDay.toordinal())
+        end = bisect.bisect_right(self.dayOrdinals, lastDay.toordinal(), lo=start)
+        return self.events[start:end]
+
+    # Returns the events from firstDay on, for example to lay out a frame that starts on that day
+    def eventsFrom(self, firstDay):
+        return self.eventsBetween(firstDay, date.max)
@@ -0,0 +1,244 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+import json
+import sqlite3
+import time
+
+from datetime import datetime
+
+
+# Local copy of the Google calendars and their events, kept up to date with the Calendar API's incremental sync.
+# Every calendar remembers the nextSyncToken from its last sync, so the next refresh only downloads what changed.
+# If the network is down, the last known good copy of the events can still be drawn.
+#
+# With singleEvents False, recurring events are stored once, with their recurrence rules, in recurringEvents, and
+# every occurrence that was moved or cancelled is remembered in recurrenceExceptions (see recurrence.py). A moved
+# occurrence is also stored in events like any other event. Switching between the two kinds of sync starts over with
+# a full sync, since the sync tokens of one kind cannot be used for the other.
+class EventStore():
+    def __init__(self, dbPath, singleEvents=True):
+        self.singleEvents = singleEvents
+        self.connection = sqlite3.connect(dbPath)
+        # Easier on the SD card: a commit appends to the write-ahead log instead of writing pages twice through a
+        # rollback journal, and the card is only synced when the log is copied into the database
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS calendars (
+                calendarId TEXT PRIMARY KEY,
+                summary TEXT NOT NULL,
+                timeZone TEXT,
+                position INTEGER NOT NULL,
+                syncToken TEXT
+            );
+            CREATE TABLE IF NOT EXISTS events (
+                calendarId TEXT NOT NULL,
+                eventId TEXT NOT NULL,
+                startEpoch INTEGER NOT NULL,
+                endEpoch INTEGER NOT NULL,
+                eventJson TEXT NOT NULL,
+                PRIMARY KEY (calendarId, eventId)
+            );
+            CREATE INDEX IF NOT EXISTS eventsByStart ON events (calendarId, startEpoch);
+            CREATE TABLE IF NOT EXISTS recurringEvents (
+                calendarId TEXT NOT NULL,
+                eventId TEXT NOT NULL,
+                eventJson TEXT NOT NULL,
+                PRIMARY KEY (calendarId, eventId)
+            );
+            CREATE TABLE IF NOT EXISTS recurrenceExceptions (
+                calendarId TEXT NOT NULL,
+                eventId TEXT NOT NULL,
+                recurringEventId TEXT NOT NULL,
+                originalStartEpoch INTEGER NOT NULL,
+                PRIMARY KEY (calendarId, eventId)
+            );
+            CREATE TABLE IF NOT EXISTS settings (
+                name TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS calendarSyncs (
+                calendarId TEXT PRIMARY KEY,
+                syncedEpoch INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS syncHorizons (
+                calendarId TEXT PRIMARY KEY,
+                horizonEpoch INTEGER NOT NULL
+            );
+        """)
+
+        syncKind = "singleEvents" if singleEvents else "recurringEvents"
+        row = self.connection.execute("SELECT value FROM settings WHERE name = 'syncKind'").fetchone()
+        if row is None or row[0] != syncKind:
+            with self.connection:
+                self.connection.execute("DELETE FROM events")
+                self.connection.execute("DELETE FROM recurringEvents")
+                self.connection.execute("DELETE FROM recurrenceExceptions")
+                self.connection.execute("UPDATE calendars SET syncToken = NULL")
+                self.connection.execute("DELETE FROM calendarSyncs")
+                self.connection.execute("DELETE FROM syncHorizons")
+                self.connection.execute("INSERT OR REPLACE INTO settings (name, value) VALUES ('syncKind', ?)",
+                                        (syncKind,))
+
+    def close(self):
+        self.connection.close()
+
+    # Remembers the calendars from calendarList().list(), in the order they were returned. Calendars that are no
+    # longer subscribed are dropped together with their events.
+    def saveCalendars(self, calendars):
+        with self.connection:
+            calendarIds = [calendar["id"] for calendar in calendars]
+            for position, calendar in enumerate(calendars):
+                self.connection.execute("""
+                    INSERT INTO calendars (calendarId, summary, timeZone, position) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (calendarId) DO UPDATE SET summary = excluded.summary, timeZone = excluded.timeZone,
+                        position = excluded.position
+                """, (calendar["id"], calendar["summary"], calendar.get("timeZone"), position))
+
+            placeholders = ",".join("?" * len(calendarIds))
+            self.connection.execute(f"DELETE FROM events WHERE calendarId NOT IN ({placeholders})", calendarIds)
+            self.connection.execute(f"DELETE FROM recurringEvents WHERE calendarId NOT IN ({placeholders})", calendarIds)
+            self.connection.execute(f"DELETE FROM recurrenceExceptions WHERE calendarId NOT IN ({placeholders})",
+                                    calendarIds)
+            self.connection.execute(f"DELETE FROM calendarSyncs WHERE calendarId NOT IN ({placeholders})", calendarIds)
+            self.connection.execute(f"DELETE FROM syncHorizons WHERE calendarId NOT IN ({placeholders})", calendarIds)
+            self.connection.execute(f"DELETE FROM calendars WHERE calendarId NOT IN ({placeholders})", calendarIds)
+
+    # Returns the stored calendars as dicts shaped like the calendarList items
+    def getCalendars(self):
+        rows = self.connection.execute("SELECT calendarId, summary, timeZone FROM calendars ORDER BY position")
+        return [{"id": row[0], "summary": row[1], "timeZone": row[2]} for row in rows]
+
+    def getSyncToken(self, calendarId):
+        row = self.connection.execute("SELECT syncToken FROM calendars WHERE calendarId = ?", (calendarId,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    # Returns when every calendar was last synced, as {calendarId: epoch seconds}. Calendars that were never synced,
+    # or have to be synced from scratch, are left out
+    def getSyncTimes(self):
+        return dict(self.connection.execute("SELECT calendarId, syncedEpoch FROM calendarSyncs"))
+
+    # Returns how far ahead the last full sync of every calendar downloaded events, as {calendarId: epoch seconds}.
+    # Events after that are only known when they changed since then
+    def getSyncHorizons(self):
+        return dict(self.connection.execute("SELECT calendarId, horizonEpoch FROM syncHorizons"))
+
+    def getSetting(self, name):
+        row = self.connection.execute("SELECT value FROM settings WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def setSetting(self, name, value):
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)", (name, str(value)))
+
+    # Applies the changes returned by events().list() for one calendar. A full sync replaces everything that was
+    # stored for the calendar, an incremental sync only touches the events that changed. syncedEpoch is when the
+    # changes were downloaded, now by default. horizonEpoch is the timeMax of a full sync, None when it had none.
+    def applyChanges(self, calendarId, changedEvents, nextSyncToken, fullSync, syncedEpoch=None, horizonEpoch=None):
+        if syncedEpoch is None:
+            syncedEpoch = int(time.time())
+
+        with self.connection:
+            if fullSync:
+                self.connection.execute("DELETE FROM events WHERE calendarId = ?", (calendarId,))
+                self.connection.execute("DELETE FROM recurringEvents WHERE calendarId = ?", (calendarId,))
+                self.connection.execute("DELETE FROM recurrenceExceptions WHERE calendarId = ?", (calendarId,))
+
+            for event in changedEvents:
+                self.connection.execute("DELETE FROM recurringEvents WHERE calendarId = ? AND eventId = ?",
+                                        (calendarId, event["id"]))
+
+                if not self.singleEvents and "recurringEventId" in event and "originalStartTime" in event:
+                    self.connection.execute("""
+                        INSERT OR REPLACE INTO recurrenceExceptions
+                            (calendarId, eventId, recurringEventId, originalStartEpoch) VALUES (?, ?, ?, ?)
+                    """, (calendarId, event["id"], event["recurringEventId"], getEventEpoch(event["originalStartTime"])))
+
+                if event.get("status") == "cancelled" or "start" not in event:
+                    self.connection.execute("DELETE FROM events WHERE calendarId = ? AND eventId = ?",
+                                            (calendarId, event["id"]))
+                    # A deleted recurring event takes its moved occurrences with it
+                    self.connection.execute("""
+                        DELETE FROM events WHERE calendarId = ? AND eventId IN (
+                            SELECT eventId FROM recurrenceExceptions WHERE calendarId = ? AND recurringEventId = ?)
+                    """, (calendarId, calendarId, event["id"]))
+                    self.connection.execute("DELETE FROM recurrenceExceptions WHERE calendarId = ? AND recurringEventId = ?",
+                                            (calendarId, event["id"]))
+                    continue
+
+                if not self.singleEvents and event.get("recurrence"):
+                    self.connection.execute("DELETE FROM events WHERE calendarId = ? AND eventId = ?",
+                                            (calendarId, event["id"]))
+                    self.connection.execute("""
+                        INSERT INTO recurringEvents (calendarId, eventId, eventJson) VALUES (?, ?, ?)
+                    """, (calendarId, event["id"], json.dumps({"summary": event.get("summary", ""), "start": event["start"],
+                                                               "end": event["end"], "recurrence": event["recurrence"]})))
+                    continue
+
+                self.connection.execute("""
+                    INSERT OR REPLACE INTO events (calendarId, eventId, startEpoch, endEpoch, eventJson)
+                    VALUES (?, ?, ?, ?, ?)
+                """, (calendarId, event["id"], getEventEpoch(event["start"]), getEventEpoch(event["end"]),
+                      json.dumps({"summary": event.get("summary", ""), "start": event["start"], "end": event["end"]})))
+
+            self.connection.execute("UPDATE calendars SET syncToken = ? WHERE calendarId = ?", (nextSyncToken, calendarId))
+            self.connection.execute("INSERT OR REPLACE INTO calendarSyncs (calendarId, syncedEpoch) VALUES (?, ?)",
+                                    (calendarId, syncedEpoch))
+            if fullSync:
+                self.connection.execute("INSERT OR REPLACE INTO syncHorizons (calendarId, horizonEpoch) VALUES (?, ?)",
+                                        (calendarId, horizonEpoch if horizonEpoch is not None else 2 ** 62))
+
+    # Forgets the sync token of a calendar, so the next sync downloads the calendar from scratch
+    def resetSyncToken(self, calendarId):
+        with self.connection:
+            self.connection.execute("UPDATE calendars SET syncToken = NULL WHERE calendarId = ?", (calendarId,))
+            self.connection.execute("DELETE FROM calendarSyncs WHERE calendarId = ?", (calendarId,))
+
+    # Returns the next maxResults events of a calendar that have not ended yet and start before beforeEpoch, ordered
+    # by start time. This mirrors what events().list(timeMin=now, timeMax=..., maxResults=..., orderBy="startTime")
+    # returns. With maxResults None, all of them are returned.
+    def getUpcomingEvents(self, calendarId, maxResults, nowEpoch=None, beforeEpoch=None):
+        if nowEpoch is None:
+            nowEpoch = int(time.time())
+        if maxResults is None:
+            maxResults = -1
+        if beforeEpoch is None:
+            beforeEpoch = 2 ** 62
+
+        rows = self.connection.execute("""
+            SELECT eventJson FROM events WHERE calendarId = ? AND endEpoch > ? AND startEpoch < ?
+            ORDER BY startEpoch, eventId LIMIT ?
+        """, (calendarId, nowEpoch, beforeEpoch, maxResults))
+        return [json.loads(row[0]) for row in rows]
+
+    # Returns the recurring events of a calendar as (eventId, eventJson)
+    def getRecurringEvents(self, calendarId):
+        rows = self.connection.execute("SELECT eventId, eventJson FROM recurringEvents WHERE calendarId = ?",
+                                       (calendarId,))
+        return rows.fetchall()
+
+    # Returns the original start epochs of the moved and cancelled occurrences of a calendar, as a frozenset for
+    # every recurring event id
+    def getRecurrenceExceptions(self, calendarId):
+        exceptions = {}
+        rows = self.connection.execute("""
+            SELECT recurringEventId, originalStartEpoch FROM recurrenceExceptions WHERE calendarId = ?
+        """, (calendarId,))
+        for recurringEventId, originalStartEpoch in rows:
+            exceptions.setdefault(recurringEventId, set()).add(originalStartEpoch)
+        return {recurringEventId: frozenset(starts) for recurringEventId, starts in exceptions.items()}
+
+    # Drops events that ended before the given time. Keeps the database small on long running frames.
+    def pruneEndedEvents(self, beforeEpoch):
+        with self.connection:
+            self.connection.execute("DELETE FROM events WHERE endEpoch < ?", (beforeEpoch,))
+            self.connection.execute("DELETE FROM recurrenceExceptions WHERE originalStartEpoch < ?", (beforeEpoch,))
+
+
+# Converts an event start or end from the Calendar API into epoch seconds. All day events use local midnight.
+def getEventEpoch(eventTime):
+    if "dateTime" in eventTime:
+        return int(datetime.fromisoformat(eventTime["dateTime"]).timestamp())
+    return int(datetime.fromisoformat(eventTime["date"]).timestamp())
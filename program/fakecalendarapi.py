@@ -0,0 +1,281 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# A local stand-in for the two Google Calendar API calls main.py makes, calendarList.list and events.list. It serves
+# generated calendars, or calendars recorded from a real account with --record, with configurable latency, error
+# rate and page size. Point main.py at it with calendarApiBaseUrl (the slim client only) to run the whole fetch path
+# without a Google account; loadtest.py does that and measures the result.
+#
+# What is supported: timeMin, timeMax, maxResults, pageToken, syncToken (an incremental sync returns no changes),
+# the items(...) part of fields, and gzip. Unknown sync tokens get 410 Gone, like the real API. --page-size splits
+# event lists into smaller pages than main.py asks for.
+import argparse
+import gzip
+import json
+import logging
+import random
+import re
+import threading
+import time
+
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, unquote, urlparse
+
+summaryWords = ["Team", "standup", "Dentist", "appointment", "Soccer", "practice", "Lunch", "with", "Larry",
+                "Quarterly", "planning", "review", "School", "holiday", "Piano", "lesson", "Design", "session"]
+
+eventsPathPattern = re.compile(r"^/calendars/([^/]+)/events$")
+fieldsItemsPattern = re.compile(r"items\(([^)]*)\)")
+
+# The sync token handed out for every calendar. The data never changes, so an incremental sync has nothing to return
+currentSyncToken = "fake-sync-1"
+
+
+# Generates calendarCount calendars with eventCount events between yesterday and dayCount days from now, sorted by
+# start time. descriptionBytes adds a description of that size to every event, to make responses bigger. The same
+# seed always gives the same calendars.
+def generateCalendarData(calendarCount, eventCount, dayCount=30, descriptionBytes=0, seed=1):
+    rng = random.Random(seed)
+    today = datetime.now().astimezone().replace(hour=0, minute=0, second=0, microsecond=0)
+
+    calendars = [{"id": f"calendar-{i}@fake", "summary": f"Calendar {i}", "timeZone": "America/Los_Angeles"}
+                 for i in range(calendarCount)]
+    events = {calendar["id"]: [] for calendar in calendars}
+
+    for i in range(eventCount):
+        calendarId = calendars[i % calendarCount]["id"]
+        event = {"id": f"event-{i}", "status": "confirmed",
+                 "summary": " ".join(rng.choice(summaryWords) for _ in range(rng.randint(1, 7)))}
+
+        day = rng.randrange(-1, dayCount)
+        if rng.random() < 0.125:
+            eventDate = (today + timedelta(days=day)).date()
+            event["start"] = {"date": eventDate.isoformat()}
+            event["end"] = {"date": (eventDate + timedelta(days=1)).isoformat()}
+        else:
+            eventStart = today + timedelta(days=day, minutes=rng.randrange(0, 24 * 60, 15))
+            event["start"] = {"dateTime": eventStart.isoformat()}
+            event["end"] = {"dateTime": (eventStart + timedelta(minutes=rng.choice([30, 60, 90]))).isoformat()}
+
+        if descriptionBytes:
+            event["description"] = "x" * descriptionBytes
+        events[calendarId].append(event)
+
+    for calendarEvents in events.values():
+        calendarEvents.sort(key=getStartEpoch)
+
+    return {"recorded": date.today().isoformat(), "calendars": calendars, "events": events}
+
+# Loads calendars saved with --record or --save. The events are moved by whole days, so the recording looks as if it
+# was made today.
+def loadCalendarData(path):
+    with open(path, "r") as dataFile:
+        data = json.load(dataFile)
+
+    shift = date.today() - date.fromisoformat(data.get("recorded", date.today().isoformat()))
+    if shift:
+        for calendarEvents in data["events"].values():
+            for event in calendarEvents:
+                for eventTime in (event.get("start"), event.get("end")):
+                    if eventTime and "dateTime" in eventTime:
+                        eventTime["dateTime"] = (datetime.fromisoformat(eventTime["dateTime"]) + shift).isoformat()
+                    elif eventTime and "date" in eventTime:
+                        eventTime["date"] = (date.fromisoformat(eventTime["date"]) + shift).isoformat()
+        data["recorded"] = date.today().isoformat()
+
+    for calendarEvents in data["events"].values():
+        calendarEvents.sort(key=getStartEpoch)
+    return data
+
+# Saves the calendars and the events of the next dayCount days of the real Google account, in the format of
+# loadCalendarData. Uses the credentials of main.py.
+def recordCalendarData(path, dayCount=30):
+    import main
+
+    main.importGoogleLibraries()
+    creds, service = main.getCalendarService()
+    calendars = service.calendarList().list().execute(http=main.getThreadHttp(creds)).get("items", [])
+
+    now = datetime.now().astimezone()
+    params = {"timeMin": (now - timedelta(days=1)).isoformat(), "timeMax": (now + timedelta(days=dayCount)).isoformat(),
+              "singleEvents": True, "orderBy": "startTime", "maxResults": 250}
+    data = {"recorded": date.today().isoformat(), "calendars": [], "events": {}}
+    for calendar in calendars:
+        data["calendars"].append({key: calendar.get(key) for key in ("id", "summary", "timeZone")})
+        data["events"][calendar["id"]] = [event for page in main.iterEventPages(service, creds, calendar, params)
+                                          for event in page.get("items", [])]
+
+    saveCalendarData(path, data)
+
+def saveCalendarData(path, data):
+    with open(path, "w") as dataFile:
+        json.dump(data, dataFile)
+
+def getStartEpoch(event):
+    start = event.get("start", {})
+    if "dateTime" in start:
+        return datetime.fromisoformat(start["dateTime"]).timestamp()
+    return datetime.fromisoformat(start.get("date", "9999-12-31")).timestamp()
+
+def getEndEpoch(event):
+    end = event.get("end", {})
+    if "dateTime" in end:
+        return datetime.fromisoformat(end["dateTime"]).timestamp()
+    return datetime.fromisoformat(end.get("date", "9999-12-31")).timestamp()
+
+def parseApiTime(value):
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+class FakeCalendarApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        api = self.server
+        url = urlparse(self.path)
+        params = dict(parse_qsl(url.query))
+        api.countRequest()
+
+        if api.latencySeconds or api.latencyJitterSeconds:
+            time.sleep(api.latencySeconds + random.uniform(0, api.latencyJitterSeconds))
+
+        if api.errorRate and random.random() < api.errorRate:
+            if random.random() < 0.5:
+                self.sendJson(503, {"error": {"code": 503, "message": "Backend Error",
+                                              "errors": [{"reason": "backendError"}]}})
+            else:
+                self.sendJson(403, {"error": {"code": 403, "message": "Rate Limit Exceeded",
+                                              "errors": [{"reason": "rateLimitExceeded"}]}})
+            return
+
+        if url.path == "/users/me/calendarList":
+            # main.py reads only the first page of the calendar list, so it is never split
+            self.sendPage(api.data["calendars"], params, {}, len(api.data["calendars"]))
+            return
+
+        match = eventsPathPattern.match(url.path)
+        if not match or unquote(match.group(1)) not in api.data["events"]:
+            self.sendJson(404, {"error": {"code": 404, "message": "Not Found", "errors": [{"reason": "notFound"}]}})
+            return
+
+        if "syncToken" in params:
+            if params["syncToken"] != currentSyncToken:
+                self.sendJson(410, {"error": {"code": 410, "message": "Sync token is no longer valid",
+                                              "errors": [{"reason": "fullSyncRequired"}]}})
+            else:
+                self.sendJson(200, {"items": [], "nextSyncToken": currentSyncToken})
+            return
+
+        events = api.data["events"][unquote(match.group(1))]
+        if "timeMin" in params:
+            timeMin = parseApiTime(params["timeMin"])
+            events = [event for event in events if getEndEpoch(event) > timeMin]
+        if "timeMax" in params:
+            timeMax = parseApiTime(params["timeMax"])
+            events = [event for event in events if getStartEpoch(event) < timeMax]
+
+        self.sendPage(events, params, {"nextSyncToken": currentSyncToken}, api.maxPageSize)
+
+    # Sends one page of items. lastPageFields are only added to the last page
+    def sendPage(self, items, params, lastPageFields, maxPageSize):
+        pageSize = max(min(int(params.get("maxResults", maxPageSize)), maxPageSize), 1)
+        offset = int(params.get("pageToken", 0))
+        page = {"items": items[offset:offset + pageSize]}
+        if offset + pageSize < len(items):
+            page["nextPageToken"] = str(offset + pageSize)
+        else:
+            page.update(lastPageFields)
+
+        fieldsMatch = fieldsItemsPattern.search(params.get("fields", ""))
+        if fieldsMatch:
+            itemFields = set(fieldsMatch.group(1).split(","))
+            page["items"] = [{key: value for key, value in item.items() if key in itemFields} for item in page["items"]]
+
+        self.sendJson(200, page)
+
+    def sendJson(self, status, body):
+        content = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            content = gzip.compress(content, compresslevel=6)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logging.debug(f"fake calendar api: {format % args}")
+
+class FakeCalendarApi(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, data, port=0, latencySeconds=0.0, latencyJitterSeconds=0.0, errorRate=0.0, maxPageSize=250):
+        super().__init__(("127.0.0.1", port), FakeCalendarApiHandler)
+        self.data = data
+        self.latencySeconds = latencySeconds
+        self.latencyJitterSeconds = latencyJitterSeconds
+        self.errorRate = errorRate
+        self.maxPageSize = maxPageSize
+        self.requestCount = 0
+        self.lock = threading.Lock()
+
+    @property
+    def baseUrl(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def countRequest(self):
+        with self.lock:
+            self.requestCount += 1
+
+    # Serves on a background thread and returns right away
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="fake-calendar-api", daemon=True).start()
+        return self
+
+
+def addServerArguments(parser):
+    parser.add_argument("--data", help="serve calendars saved with --record or --save instead of generated ones")
+    parser.add_argument("--calendars", type=int, default=20, help="number of generated calendars")
+    parser.add_argument("--events", type=int, default=500, help="number of generated events")
+    parser.add_argument("--days", type=int, default=30, help="generated events are spread over this many days")
+    parser.add_argument("--description-bytes", type=int, default=0, help="size of the description of every event")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the generated calendars")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds every request waits")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many extra seconds of wait")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests that fail, 0.05 = 5%%")
+    parser.add_argument("--page-size", type=int, default=250, help="largest page the server returns")
+
+def createServer(args, port=0):
+    if args.data:
+        data = loadCalendarData(args.data)
+    else:
+        data = generateCalendarData(args.calendars, args.events, args.days, args.description_bytes, args.seed)
+    return FakeCalendarApi(data, port, args.latency, args.jitter, args.error_rate, args.page_size)
+
+def runServer():
+    parser = argparse.ArgumentParser(description="Serves fake Google Calendar API responses on localhost")
+    addServerArguments(parser)
+    parser.add_argument("--port", type=int, default=8074, help="port to listen on")
+    parser.add_argument("--save", metavar="FILE", help="save the generated calendars to FILE and exit")
+    parser.add_argument("--record", metavar="FILE", help="save the calendars of your Google account to FILE and exit")
+    args = parser.parse_args()
+
+    if args.record:
+        recordCalendarData(args.record, args.days)
+        print(f"Calendars recorded to {args.record}")
+        return
+
+    server = createServer(args, args.port)
+    if args.save:
+        saveCalendarData(args.save, server.data)
+        print(f"Calendars saved to {args.save}")
+        return
+
+    eventCount = sum(len(events) for events in server.data["events"].values())
+    print(f"Serving {len(server.data['calendars'])} calendars with {eventCount} events at {server.baseUrl}")
+    print(f"Set calendarApiBaseUrl = \"{server.baseUrl}\" in main.py to use it")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    runServer()
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+import logging
+import os
+import time
+
+from framebuffer import newPanelImage, packColorCodes
+
+
+# Pull the left and right pixel out of a packed byte
+highCodeTable = bytes(byte >> 4 for byte in range(256))
+lowCodeTable = bytes(byte & 0x0f for byte in range(256))
+
+
+# Stand-in for waveshare_epd.epd7in3f.EPD that needs no HAT or GPIO. It has the same init/getbuffer/display/Clear/
+# sleep surface, writes every displayed frame to outputDir as a PNG and as the raw packed buffer, and waits about as
+# long as the real panel would. This makes it possible to run and profile the whole program on a regular computer.
+#
+# The waits can be scaled with latencyScale. 1.0 waits as long as the panel, 0 does not wait at all.
+class FileEPD():
+    # Display resolution
+    width = 800
+    height = 480
+
+    # Same color constants as epd7in3f.EPD
+    BLACK  = 0x000000   #   0000  BGR
+    WHITE  = 0xffffff   #   0001
+    GREEN  = 0x00ff00   #   0010
+    BLUE   = 0xff0000   #   0011
+    RED    = 0x0000ff   #   0100
+    YELLOW = 0x00ffff   #   0101
+    ORANGE = 0x0080ff   #   0110
+
+    # Approximate timings of the 7.3 inch ACeP panel, in seconds
+    initSeconds = 2.0
+    refreshSeconds = 30.0
+    sleepSeconds = 2.0
+    spiSpeedHz = 4000000
+
+    def __init__(self, outputDir, latencyScale=1.0):
+        self.outputDir = outputDir
+        self.latencyScale = latencyScale
+        self.displayCount = 0
+        os.makedirs(outputDir, exist_ok=True)
+
+    def wait(self, seconds):
+        if self.latencyScale > 0:
+            time.sleep(seconds * self.latencyScale)
+
+    def init(self):
+        self.wait(self.initSeconds)
+        return 0
+
+    # Same conversion as epd7in3f.getbuffer: quantize the frame to the 7 panel colors, then pack two pixels per byte
+    def getbuffer(self, image):
+        imageWidth, imageHeight = image.size
+        if (imageWidth, imageHeight) == (self.height, self.width):
+            image = image.rotate(90, expand=True)
+        elif (imageWidth, imageHeight) != (self.width, self.height):
+            logging.warning(f"Invalid image dimensions: {imageWidth} x {imageHeight}, expected {self.width} x {self.height}")
+
+        panelImage = image.convert("RGB").quantize(palette=newPanelImage((1, 1)))
+        return packColorCodes(panelImage.tobytes())
+
+    def display(self, image):
+        buffer = bytes(image)
+        self.wait(len(buffer) * 8 / self.spiSpeedHz)
+
+        with open(os.path.join(self.outputDir, "display.bin"), "wb") as bufferFile:
+            bufferFile.write(buffer)
+        self.unpackBuffer(buffer).save(os.path.join(self.outputDir, "display.png"))
+
+        self.displayCount += 1
+        logging.info(f"Frame {self.displayCount} written to {self.outputDir}")
+        self.wait(self.refreshSeconds)
+
+    def Clear(self, color=0x11):
+        self.display(bytes([color]) * (self.width * self.height // 2))
+
+    def sleep(self):
+        self.wait(self.sleepSeconds)
+
+    # Turns a packed panel buffer back into an image, showing what the panel would show
+    def unpackBuffer(self, buffer):
+        colorCodes = bytearray(len(buffer) * 2)
+        colorCodes[0::2] = buffer.translate(highCodeTable)
+        colorCodes[1::2] = buffer.translate(lowCodeTable)
+
+        image = newPanelImage((self.width, self.height))
+        image.frombytes(bytes(colorCodes))
+        return image
@@ -0,0 +1,75 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+from PIL import Image
+
+
+# The 7 colors of the ACeP panel, in the order of their 4 bit panel codes. Same palette as epd7in3f.getbuffer
+panelPalette = (
+    0, 0, 0,        # 0000 black
+    255, 255, 255,  # 0001 white
+    0, 255, 0,      # 0010 green
+    0, 0, 255,      # 0011 blue
+    255, 0, 0,      # 0100 red
+    255, 255, 0,    # 0101 yellow
+    255, 128, 0,    # 0110 orange
+)
+
+# Shifts a 4 bit color code into the high nibble of a byte
+highNibbleTable = bytes((code << 4) & 0xff for code in range(256))
+
+
+# Creates an image that is drawn directly in panel colors. Pixel values are the 4 bit panel codes, so the image never
+# has to be quantized to the panel palette before it is sent.
+def newPanelImage(size, fillCode=1):
+    image = Image.new("P", size, fillCode)
+    image.putpalette(panelPalette + (0, 0, 0) * 249)
+    return image
+
+# Packs a palette image from newPanelImage into the byte buffer that epd.display() sends to the panel: two pixels
+# per byte, the left pixel in the high nibble. Gives the same bytes as epd7in3f.getbuffer() for the same image,
+# without the quantize step and without a Python loop over all 384,000 pixels.
+def packPanelBuffer(image, panelWidth, panelHeight):
+    imageWidth, imageHeight = image.size
+    if (imageWidth, imageHeight) == (panelHeight, panelWidth):
+        # Portrait image, turn it the same way getbuffer does
+        image = image.rotate(90, expand=True)
+    elif (imageWidth, imageHeight) != (panelWidth, panelHeight):
+        raise ValueError(f"Invalid image dimensions: {imageWidth} x {imageHeight}, expected {panelWidth} x {panelHeight}")
+
+    return packColorCodes(image.tobytes())
+
+# Packs a run of 4 bit color codes, one per byte, into half as many bytes. The even codes are moved into the high
+# nibble with a translate table. Since the high and low halves never overlap, OR-ing them as two big integers
+# combines every pair of pixels at once.
+def packColorCodes(colorCodes):
+    packedLength = len(colorCodes) // 2
+    highNibbles = int.from_bytes(colorCodes[0::2].translate(highNibbleTable), "big")
+    lowNibbles = int.from_bytes(colorCodes[1::2], "big")
+    return bytearray((highNibbles | lowNibbles).to_bytes(packedLength, "big"))
+
+# Draws a frame band by band and packs each band straight into the panel buffer, so the whole frame is never in
+# memory as an image: only one band of bandRows panel rows and the 192 KB packed buffer. imageSize is the size of the
+# frame as drawn, portrait or landscape like for packPanelBuffer. drawBand(image, left, top) draws the part of the
+# frame that starts at (left, top) onto image. Gives the same bytes as drawing the whole frame and packing it.
+def renderPanelBands(imageSize, panelWidth, panelHeight, bandRows, drawBand):
+    imageWidth, imageHeight = imageSize
+    portrait = (imageWidth, imageHeight) == (panelHeight, panelWidth)
+    if not portrait and (imageWidth, imageHeight) != (panelWidth, panelHeight):
+        raise ValueError(f"Invalid image dimensions: {imageWidth} x {imageHeight}, expected {panelWidth} x {panelHeight}")
+
+    panelBuffer = bytearray(panelWidth * panelHeight // 2)
+    for bandStart in range(0, panelHeight, bandRows):
+        bandEnd = min(panelHeight, bandStart + bandRows)
+        if portrait:
+            # The portrait image is turned a quarter to the left, so panel row r is image column imageWidth - 1 - r.
+            # A band of panel rows is a strip of image columns, counted from the right
+            image = newPanelImage((bandEnd - bandStart, imageHeight))
+            drawBand(image, imageWidth - bandEnd, 0)
+            image = image.rotate(90, expand=True)
+        else:
+            image = newPanelImage((imageWidth, bandEnd - bandStart))
+            drawBand(image, 0, bandStart)
+
+        panelBuffer[bandStart * panelWidth // 2:bandEnd * panelWidth // 2] = packColorCodes(image.tobytes())
+
+    return panelBuffer
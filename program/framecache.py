@@ -0,0 +1,49 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+import zlib
+
+
+# Frames drawn ahead of time for the moments the calendar is known to change: midnight, when the "Today" and
+# "Tomorrow" labels move, and the end of an event, when it drops off. Each frame is kept by the epoch time of its
+# change, with the fingerprint of its layout and the events it shows. The packed panel buffers are mostly white, so
+# they are kept zlib compressed; a frame takes a few KB instead of 192 KB.
+#
+# sourceEvents and sourceComplete are the events the frames were laid out from, and whether those were all the
+# events there are. main.py checks them after the next fetch to see whether the frames are still right.
+class PrecomputedFrames():
+    def __init__(self, compressionLevel=6):
+        self.compressionLevel = compressionLevel
+        self.clear()
+
+    def clear(self):
+        self.frames = {}
+        self.sourceEvents = []
+        self.sourceComplete = False
+
+    def __len__(self):
+        return len(self.frames)
+
+    def add(self, changeEpoch, fingerprint, panelBuffer, piEvents):
+        self.frames[changeEpoch] = (fingerprint, zlib.compress(bytes(panelBuffer), self.compressionLevel), piEvents)
+
+    # Returns the change times of the frames, earliest first
+    def getChangeTimes(self):
+        return sorted(self.frames)
+
+    # Removes the frames whose change is at or before nowEpoch and returns the latest of them as
+    # (fingerprint, panel buffer, events), or None when there is none
+    def take(self, nowEpoch):
+        dueTimes = [changeEpoch for changeEpoch in self.frames if changeEpoch <= nowEpoch]
+        if not dueTimes:
+            return None
+
+        frame = self.frames[max(dueTimes)]
+        for changeEpoch in dueTimes:
+            del self.frames[changeEpoch]
+
+        fingerprint, compressedBuffer, piEvents = frame
+        return fingerprint, zlib.decompress(compressedBuffer), piEvents
+
+    # Bytes taken by the compressed panel buffers
+    def getStoredBytes(self):
+        return sum(len(compressedBuffer) for fingerprint, compressedBuffer, piEvents in self.frames.values())
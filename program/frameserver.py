@@ -0,0 +1,123 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+import hashlib
+import logging
+import os
+import re
+import threading
+import urllib.error
+import urllib.request
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Serves packed panel buffers over HTTP, so a stronger computer can do the fetching and drawing and a Pi Zero only
+# has to download the buffer and send it to the panel (main.py --serve and main.py --client URL).
+#
+# GET /frames/<name> returns the packed buffer of a frame with an ETag. A client that sends the ETag of the frame it
+# already shows in If-None-Match gets 304 Not Modified and nothing else. The frame "default" is the calendar drawn by
+# main.py; the buffer of a panel profile made by panels.py is served under the name of its folder.
+
+framePathPattern = re.compile(r"^/frames/([A-Za-z0-9_.-]+)$")
+
+
+# Holds the frames rendered in this process, by name. Frames are replaced by the render loop while the server
+# threads read them.
+class FrameStore():
+    def __init__(self, panelsDir=None, panelBufferFile="display.bin"):
+        self.lock = threading.Lock()
+        self.frames = {}
+        self.panelsDir = panelsDir
+        self.panelBufferFile = panelBufferFile
+        self.fileETags = {}
+
+    def setFrame(self, name, buffer, etag):
+        with self.lock:
+            self.frames[name] = (etag, bytes(buffer))
+
+    def getETag(self, name):
+        with self.lock:
+            frame = self.frames.get(name)
+        return frame[0] if frame else None
+
+    # Returns (etag, buffer) of a frame, or None. Frames of panel profiles are read from disk, and their ETag is
+    # only worked out again when the file changed.
+    def getFrame(self, name):
+        with self.lock:
+            frame = self.frames.get(name)
+        if frame is not None or self.panelsDir is None or name.startswith("."):
+            return frame
+
+        bufferPath = os.path.join(self.panelsDir, name, self.panelBufferFile)
+        try:
+            with open(bufferPath, "rb") as bufferFile:
+                fileStat = os.fstat(bufferFile.fileno())
+                buffer = bufferFile.read()
+        except FileNotFoundError:
+            return None
+
+        fileKey = (fileStat.st_mtime_ns, fileStat.st_size)
+        with self.lock:
+            cached = self.fileETags.get(name)
+            if cached is None or cached[0] != fileKey:
+                cached = (fileKey, hashlib.sha256(buffer).hexdigest()[:32])
+                self.fileETags[name] = cached
+        return cached[1], buffer
+
+class FrameRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        match = framePathPattern.match(self.path)
+        frame = self.server.frameStore.getFrame(match.group(1)) if match else None
+        if frame is None:
+            self.sendResponse(404, b"Unknown frame\n", "text/plain")
+            return
+
+        etag, buffer = frame
+        quotedETag = f'"{etag}"'
+        if quotedETag in [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]:
+            self.sendResponse(304, b"", None, quotedETag)
+        else:
+            self.sendResponse(200, buffer, "application/octet-stream", quotedETag)
+
+    def sendResponse(self, status, body, contentType, etag=None):
+        self.send_response(status)
+        if contentType:
+            self.send_header("Content-Type", contentType)
+        if etag:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f"{self.address_string()} {format % args}")
+
+# Starts serving the frames of frameStore on a background thread. Returns the server; server.server_port is the port
+# it listens on, which is useful with port 0. Only this computer can connect unless host is another address.
+def startFrameServer(frameStore, host="127.0.0.1", port=8073):
+    server = ThreadingHTTPServer((host, port), FrameRequestHandler)
+    server.daemon_threads = True
+    server.frameStore = frameStore
+    threading.Thread(target=server.serve_forever, name="frame-server", daemon=True).start()
+    logging.info(f"Serving frames on {host}:{server.server_port}")
+    return server
+
+
+# Downloads a frame. With the ETag of the frame already on screen, the server answers 304 when the frame did not
+# change. Returns (etag, buffer), with buffer None when the frame did not change.
+def fetchFrame(url, etag=None, timeoutSeconds=20):
+    request = urllib.request.Request(url)
+    if etag:
+        request.add_header("If-None-Match", f'"{etag}"')
+
+    try:
+        with urllib.request.urlopen(request, timeout=timeoutSeconds) as response:
+            return response.headers.get("ETag", "").strip('"'), response.read()
+    except urllib.error.HTTPError as error:
+        if error.code == 304:
+            return etag, None
+        raise
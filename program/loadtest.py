@@ -0,0 +1,148 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# End to end load test of a refresh: fetches the calendars from a fake Calendar API (see fakecalendarapi.py), lays
+# them out, draws them and packs the panel buffer, the same path main.py takes up to the panel. No Google account or
+# display is involved. Reports the time of every run, the API calls and bytes it took, and the peak memory.
+#
+# With the event store on (the default in main.py), the first run is a full sync and the later runs are incremental
+# syncs against a fresh store in a temporary folder, so the numbers show both.
+#
+# --max-rss-kb and --max-traced-kb make it a memory budget check: it fails when the process or one refresh needs more
+# memory than that. --trace-stages shows which stage the memory goes to.
+import argparse
+import json
+import logging
+import os
+import statistics
+import tempfile
+
+import main
+import requests
+from fakecalendarapi import addServerArguments, createServer
+from fileepd import FileEPD
+from runmetrics import getMaxRssKb
+
+# Font.ttc, the footer font, is copied from the Waveshare examples by hand and is not in resources/. The load test
+# draws the footer with a font that is, so it runs on a fresh checkout
+main.updatedFont = ("FreeSans.ttf", main.updatedFont[1])
+
+
+# Stands in for the Google credentials. The fake server does not check them
+class FakeCredentials():
+    valid = True
+
+
+# Points main.py at the Calendar API at baseUrl
+def useCalendarApi(baseUrl):
+    main.useSlimCalendarClient = True
+    main.calendarApiBaseUrl = baseUrl
+    main.importGoogleLibraries()
+    main.calendarCreds = FakeCredentials()
+    main.calendarService = main.buildSlimCalendarService(requests.Session())
+
+# Stands in for the panel. Only its size and getbuffer are used, nothing is displayed
+panel = None
+
+# One refresh up to the panel buffer, drawn the way main.py draws it. Returns the metrics record of the run
+def runRefresh():
+    global panel
+
+    if panel is None:
+        panel = FileEPD(os.path.join(main.resdir, main.fileDisplayDir), latencyScale=0)
+
+    main.metrics.reset()
+    with main.metrics.stage("refresh"):
+        with main.metrics.stage("layout"):
+            displayList, piEvents = main.layoutCalendars(main.loadCalendarEvents(), main.originX, main.originY)
+        main.renderPanelBuffer(panel, displayList)
+    return main.metrics.getRecord()
+
+# Runs one refresh under tracemalloc and returns the peak memory it allocated in KB
+def measurePeakMemory():
+    main.metrics.tracePeakMemory = True
+    return runRefresh()["peakTracedKb"]
+
+def printStageMemory(record):
+    print(f"\n{'stage':24} {'peak KB':>9} {'max RSS KB':>11}  top allocators")
+    for name, memory in record["stageMemory"].items():
+        allocators = ", ".join(memory["topAllocators"][:3])
+        print(f"{name:24} {memory['peakKb']:9.1f} {memory['maxRssKb']:11}  {allocators}")
+
+def runLoadTest():
+    parser = argparse.ArgumentParser(description="Runs the refresh of main.py against a fake Calendar API and "
+                                                 "measures it")
+    addServerArguments(parser)
+    parser.add_argument("--url", help="use the fake Calendar API already running at this address instead of "
+                                      "starting one")
+    parser.add_argument("--runs", type=int, default=5, help="number of refreshes to time")
+    parser.add_argument("--no-event-store", action="store_true", help="fetch everything on every run")
+    parser.add_argument("--json", metavar="FILE", help="also write the results to FILE")
+    parser.add_argument("--low-memory", action="store_true", help="turn on lowMemoryMode of main.py")
+    parser.add_argument("--trace-stages", action="store_true",
+                        help="show the peak memory and top allocators of every stage of the last run")
+    parser.add_argument("--max-rss-kb", type=int,
+                        help="fail when the max RSS of the process goes over this many KB")
+    parser.add_argument("--max-traced-kb", type=int, default=main.memoryBudgetKb,
+                        help="fail when one refresh allocates more than this many KB at its peak (memoryBudgetKb)")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.ERROR)
+
+    server = None
+    baseUrl = args.url
+    if baseUrl is None:
+        server = createServer(args).start()
+        baseUrl = server.baseUrl
+        eventCount = sum(len(events) for events in server.data["events"].values())
+        print(f"{eventCount} events in {len(server.data['calendars'])} calendars, {args.latency * 1000:.0f} ms "
+              f"latency, {args.error_rate:.0%} errors\n")
+
+    main.loadConfigFiles()
+    main.useEventStore = not args.no_event_store
+    main.lowMemoryMode = main.lowMemoryMode or args.low_memory
+    main.metrics.traceMemory = args.trace_stages
+    useCalendarApi(baseUrl)
+
+    with tempfile.TemporaryDirectory() as storeDir:
+        main.eventStoreFile = os.path.join(storeDir, "events.db")
+
+        records = []
+        print(f"{'run':>4} {'seconds':>9} {'api calls':>10} {'KB received':>12} {'events':>7}")
+        for run in range(args.runs):
+            record = runRefresh()
+            records.append(record)
+            counters = record["counters"]
+            print(f"{run + 1:4} {record['stageSeconds']['refresh']:9.3f} {counters.get('api_calls', 0):10} "
+                  f"{counters.get('bytes_received', 0) / 1024:12.1f} {counters.get('events_loaded', 0):7}")
+
+        peakKb = measurePeakMemory()
+
+    if args.trace_stages:
+        printStageMemory(records[-1])
+
+    seconds = [record["stageSeconds"]["refresh"] for record in records]
+    maxRssKb = getMaxRssKb()
+    print(f"\nseconds min {min(seconds):.3f}, median {statistics.median(seconds):.3f}, max {max(seconds):.3f}")
+    print(f"peak traced memory of one refresh {peakKb:.1f} KB, max RSS of the process {maxRssKb} KB")
+    if server is not None:
+        print(f"{server.requestCount} requests served")
+
+    if args.json:
+        with open(args.json, "w") as resultsFile:
+            json.dump({"url": baseUrl, "runs": records, "peakKb": peakKb, "maxRssKb": maxRssKb}, resultsFile,
+                      indent=2)
+
+    # The fake server runs in this process too; start it apart and use --url to leave it out of the RSS
+    failures = []
+    if args.max_rss_kb is not None and maxRssKb > args.max_rss_kb:
+        failures.append(f"max RSS {maxRssKb} KB is over the budget of {args.max_rss_kb} KB")
+    if args.max_traced_kb is not None and peakKb > args.max_traced_kb:
+        failures.append(f"peak traced memory {peakKb:.1f} KB is over the budget of {args.max_traced_kb} KB")
+    if failures:
+        print("\nMemory budget exceeded:")
+        for failure in failures:
+            print(f"  {failure}")
+        exit(1)
+
+if __name__ == "__main__":
+    runLoadTest()
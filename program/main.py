@@ -2,11 +2,14 @@
 # -*- coding:utf-8 -*-
 import sys
 import os
+import argparse
 import socket
 import fcntl
 import struct
+import threading
 
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date, timezone, timedelta
 import time
 import os.path
@@ -16,16 +19,32 @@ libdir = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__)
 if os.path.exists(libdir):
     sys.path.append(libdir)
 
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-
+import atexit
+import functools
+import gc
+import heapq
+import operator
+import itertools
+import json
 import logging
-from waveshare_epd import epd7in3f
+import signal
+from collections import namedtuple
+from eventindex import EventIndex
+from eventstore import EventStore, getEventEpoch
+from framecache import PrecomputedFrames
+from displaylist import (TextItem, LineItem, BoxItem, TextMeasurer, clipDisplayList, drawDisplayList,
+                         getDisplayListFingerprint)
+from framebuffer import newPanelImage, packPanelBuffer, renderPanelBands
+from runmetrics import RunMetrics
+from spritecache import TextSpriteCache
+from statestore import StateStore
 from PIL import Image,ImageDraw,ImageFont
 
+# The Google client libraries and the Waveshare driver are slow to import on a Pi Zero. They are imported the first
+# time they are needed (see importGoogleLibraries and importDisplayDriver), so fake events never load the Google
+# libraries and --help returns right away.
+epd7in3f = None
+
 
 # If modifying these scopes, delete the file token.json.
 SCOPES = ["https://www.googleapis.com/auth/calendar.readonly"]
@@ -44,28 +63,8 @@ originY = 20
 maxX = 439  # max panel x is actually 479
 maxY = 679  # max panel y is actually 799
 
-# Calendar event
-eventRectangleWidth = maxX-20
-eventRectangleHeight = 45
-
-# Left and right gutters. Right gutter is shown for all day events only
-gutterWidth = 15
-gutterHeight = 45
-
-eventTimeOffsetX = 30   # From the startX of the eventRectangle
-eventTimeOffsetY = 12   # From the startY of the eventRectangle
-
-# one-line events
-eventDescrOffsetX = 180  # From the startX of the eventRectangle
-eventDescrOffsetY = 12    # From the startY of the eventRectangle
-
-# first line of two-line events
-eventDescrOneOffsetX = 180  # From the startX of the eventRectangle
-eventDescrOneOffsetY = 2    # From the startY of the eventRectangle
-
-# second line of two-line events
-eventDescrTwoOffsetX = 180  # From the startX of the eventRectangle
-eventDescrTwoOffsetY = 23    # From the startY of the eventRectangle
+# Number of days drawn, starting with today. Events are only downloaded up to the end of the last day
+displayDays = 10
 
 # Add this value to eventOriginY to get the next eventOriginY for the next day
 dayHeaderHeight = 45
@@ -76,14 +75,22 @@ eventSpacer = 10
 # Add this value to eventOriginY to get the next eventOriginY for the next event
 eventHeight = 45
 
-# The number of characters allowed on the first line before a break is forced to the second line
-eventCharLimit = 26
+# Pixels kept free between the event summary and the right edge of the event rectangle
+eventSummaryPaddingRight = 8
+
+# Fonts, as (file in resources, size). Each font is loaded by getFont the first time it is drawn with
+#eventFont = ('Font.ttc', 18)
+eventFont = ('FreeSansBold.ttf', 18)
+dayFont = ('FreeSans.ttf', 23)
+dayNumFont = ('FreeSans.ttf', 40)
+updatedFont = ('Font.ttc', 16)
 
-# Fonts
-#eventFont = ImageFont.truetype(os.path.join(resdir, 'Font.ttc'), 18)
-eventFont = ImageFont.truetype(os.path.join(resdir, 'FreeSansBold.ttf'), 18)
-dayFont = ImageFont.truetype(os.path.join(resdir, 'FreeSans.ttf'), 23)
-dayNumFont = ImageFont.truetype(os.path.join(resdir, 'FreeSans.ttf'), 40)
+# Set to True to keep rasterized text in memory and reuse it instead of rendering the same strings again. In daemon
+# mode the cache lives as long as the process. Set textSpriteCacheDir to a folder name in resources to also keep the
+# text on disk between runs.
+useTextSpriteCache = True
+textSpriteCacheSize = 512
+textSpriteCacheDir = None
 
 # Colors
 epd_BLACK  = 0x000000   #   0000  BGR
@@ -94,47 +101,288 @@ epd_RED    = 0x0000ff   #   0100
 epd_YELLOW = 0x00ffff   #   0101
 epd_ORANGE = 0x0080ff   #   0110
 
+# The 4 bit panel code of each color, used when drawing straight into panel colors (see renderPanelColors)
+panelColorCodes = {
+    epd_BLACK: 0,
+    epd_WHITE: 1,
+    epd_GREEN: 2,
+    epd_BLUE: 3,
+    epd_RED: 4,
+    epd_YELLOW: 5,
+    epd_ORANGE: 6,
+}
+
+# Set to True to draw the calendar straight into the 7 panel colors and pack the panel buffer directly. This skips
+# the slow quantize step in epd.getbuffer() and the extra full size RGB copies. Text is drawn without anti-aliasing,
+# which the panel could not show anyway. Set to False to draw in RGB and let epd.getbuffer() convert the frame.
+renderPanelColors = True
+
+# Set to True on a 512 MB Pi Zero that shares its memory with other services. The frame is then drawn in bands of
+# renderBandRows panel rows, each packed straight into the panel buffer, instead of as a full 480x800 image that is
+# packed afterwards (see renderPanelBands). Drawing takes a little longer, since text that spans several bands is
+# stamped once per band. Only works with renderPanelColors.
+lowMemoryMode = False
+renderBandRows = 96
+
+# Set to True to record the peak memory and the source lines that allocated the most of it for every stage in the run
+# metrics (see runmetrics.py). It makes the run several times slower, so only turn it on to find out where the
+# memory goes.
+traceStageMemory = False
+
+# Peak memory in KB that one refresh should stay under, as traced by tracemalloc (peakTracedKb in the run metrics).
+# The peak is measured again for every refresh, also in daemon mode. A refresh that goes over logs a warning and
+# counts memory_budget_exceeded in the run metrics, and loadtest.py fails. Tracing makes Python allocate a little
+# slower. Set to None for no budget.
+memoryBudgetKb = None
+
 # Reads the values in resources/color-map.txt to assign colors to the calendars
 colorMap = {}
 
+# Populated by resources/calendar-policies.txt, by calendar name. See getCalendarPolicy
+calendarPolicies = {}
+CalendarPolicy = namedtuple("CalendarPolicy", ["refreshMinutes", "days", "maxEvents"])
+
 # Set to True to generate fake events. Useful if the Google calendar API is not available for some reason
 makeFakeEvents = False
 
+# Number of calendars whose events are fetched at the same time. Set to 1 to fetch the calendars one by one
+fetchConcurrency = 6
+
+# Seconds to wait on the network for a single calendar before it is skipped for this refresh
+fetchTimeoutSeconds = 20
+
+# Set to True to talk to the Calendar API through the small client in calendarclient.py instead of the
+# googleapiclient discovery service. It skips the discovery document and httplib2, keeps one pooled keep-alive
+# connection for all calendars, asks for gzipped responses and retries rate limits and server errors with backoff.
+useSlimCalendarClient = True
+
+# Only used with useSlimCalendarClient. Point this at a stand-in server to run without a Google account
+calendarApiBaseUrl = "https://www.googleapis.com/calendar/v3"
+
+# The number of upcoming events shown for each calendar. Set to None to show every event in the next displayDays days
+maxEventsPerCalendar = 10
+
+# Calendars can have their own fetch policy in resources/calendar-policies.txt: how often they are fetched, how many
+# days ahead and how many events. Calendars without one are fetched on every refresh. The list of calendars itself
+# is fetched at most every calendarListRefreshMinutes, from the event store or, in daemon mode, from memory.
+calendarListRefreshMinutes = 60
+
+# Only these fields of each event are downloaded, everything else in the API response is left out
+eventFields = "items(id,status,summary,start,end),nextPageToken,nextSyncToken"
+recurringEventFields = ("items(id,status,summary,start,end,recurrence,recurringEventId,originalStartTime),"
+                        "nextPageToken,nextSyncToken")
+
+# Set to True to download a recurring event once, with its recurrence rules, and work out its occurrences locally
+# (see recurrence.py) instead of downloading every occurrence of every recurring event again. Only works with
+# useEventStore and needs the python-dateutil package; without it, the occurrences are downloaded as before.
+expandRecurringEvents = False
+
+# Set to True to keep a local copy of the calendars in resources/events.db. Each refresh then only downloads the
+# changes since the last refresh, and the last synced events are still drawn when the network is down.
+useEventStore = True
+eventStoreFile = "events.db"
+storedEventPageSize = 25
+
+# A full sync of the event store downloads the events of this many days ahead (at least displayDays). Changes after
+# that are still picked up, and the calendar is downloaded again once the last day drawn gets past these days. A
+# larger number means fewer full syncs, but more occurrences of recurring events in each one.
+fullSyncDays = 31
+
+# Set to True to leave the screen alone when the calendar looks the same as on the last refresh. A full refresh of the
+# panel takes about 30 seconds of flashing, so most runs from cron become a quick no-op.
+skipUnchangedFrames = True
+lastFrameFile = "last-frame.txt"
+
+# An unchanged frame is still redrawn after this many hours to clear ghosting. Set to None to never force a refresh
+forceRefreshHours = 24
+
+# In daemon mode (main.py --daemon), check Google calendar for changes at least this often
+pollIntervalMinutes = 15
+
+# In daemon mode, the frames for the moments the calendar is known to change (midnight and the end of an event) are
+# drawn right after a refresh, for the next precomputeHours hours. When the moment comes, the ready frame is sent to
+# the panel without fetching or drawing anything, as long as the last fetch is less than pollIntervalMinutes old.
+# precomputeLookahead is the number of events read past the end of the frame, for the events that move up into it.
+usePrecomputedFrames = True
+precomputeHours = 24
+maxPrecomputedFrames = 16
+precomputeLookahead = 20
+
+# main.py --serve renders the calendar and serves the packed panel buffer on this port, for frames that run
+# main.py --client http://<server>:<port>/frames/default (see frameserver.py)
+frameServerPort = 8073
+# The frames are served without any authentication, so only to this computer by default. Set to "0.0.0.0" to serve
+# them to the frames on the local network, or to the address of the computer on that network.
+frameServerHost = "127.0.0.1"
+
+# Every refresh writes its stage timings and counters to resources/metrics.json (or metrics.json in stateHotDir). Set prometheusTextFile to a path in
+# the node exporter textfile collector directory, e.g. /var/lib/node_exporter/textfile_collector/picalendar.prom,
+# to also export them to Prometheus.
+metricsFile = "metrics.json"
+prometheusTextFile = None
+
+# token.json, last-frame.txt, metrics.json and the text cache are written through statestore.py: only when their
+# content changed, and renamed into place so a power cut never leaves half a file. The files that change on most runs
+# are kept in memory and written together at the end of a run from cron, or every stateFlushMinutes in daemon mode.
+# Set stateHotDir to a folder on tmpfs, e.g. /run/picalendar, to keep them there instead and copy them to the SD card
+# at most every stateFlushMinutes; a reboot then loses at most that much of them. metrics.json is never copied from
+# stateHotDir, and without it, it goes to the SD card at most every stateFlushMinutes.
+stateHotDir = None
+stateFlushMinutes = 360
+
+# Where frames go: "waveshare" for the e-ink panel, "file" to write them to resources/display-output instead. The
+# file display waits as long as the real panel would, scaled by fileDisplayLatencyScale (0 to not wait at all).
+displayBackend = "waveshare"
+fileDisplayDir = "display-output"
+fileDisplayLatencyScale = 1.0
+
+# Wait for the e-ink panel through epdtransfer.py: the BUSY wait sleeps until the pin changes, instead of checking it
+# every 5 ms. Set to False to use the Waveshare driver as it is.
+useFastPanelTransfer = True
+
+# Wake the panel (epd.init, a few seconds of reset and BUSY wait) on a separate thread while the calendars are
+# fetched and drawn, instead of after. When the frame may turn out unchanged, the panel is only woken once the layout
+# shows it changed, so it still overlaps the drawing and packing.
+pipelinePanelInit = True
+
+
+@functools.cache
+def getFont(fontSpec):
+    fontFile, fontSize = fontSpec
+    return ImageFont.truetype(os.path.join(resdir, fontFile), fontSize)
+
+# Measures text for wrapping event summaries. Keeps the width of every word it has seen
+textMeasurer = TextMeasurer(getFont)
+
+# Stage timings and counters of the current refresh
+metrics = RunMetrics()
+
+# Text drawn through drawText is rasterized once and reused from this cache. See spritecache.py
+textSprites = None
+
+# Writes the files kept between runs. See getStateStore
+stateStore = None
+
+# Returns the value to draw a color with. Palette images are drawn with panel codes instead of RGB values
+def getInk(draw, color):
+    if draw.mode == "P":
+        return panelColorCodes[color]
+    return color
+
+def drawText(draw, xy, text, fontSpec, fill):
+    global textSprites
+
+    fill = getInk(draw, fill)
+
+    if not useTextSpriteCache:
+        draw.text(xy, text, font = getFont(fontSpec), fill = fill)
+        return
+
+    if textSprites is None:
+        cacheDir = os.path.join(resdir, textSpriteCacheDir) if textSpriteCacheDir else None
+        textSprites = TextSpriteCache(getFont, textSpriteCacheSize, cacheDir, getStateStore())
+
+    textSprites.drawText(draw, xy, text, fontSpec, fill)
+
+# Returns the store for the files in resources that change at run time. Created the first time it is needed, after
+# the settings are loaded. What is still in memory is written when the program ends.
+def getStateStore():
+    global stateStore
+
+    if stateStore is None:
+        stateStore = StateStore(resdir, stateHotDir, stateFlushMinutes * 60)
+        atexit.register(stateStore.close)
+    return stateStore
+
+def importGoogleLibraries():
+    global Request, Credentials, TransportError, apiErrors, fetchErrors
+    global build, HttpError, AuthorizedHttp, httplib2
+
+    from google.auth.exceptions import TransportError
+    from google.auth.transport.requests import Request
+    from google.oauth2.credentials import Credentials
+
+    if useSlimCalendarClient:
+        from calendarclient import CalendarApiError
+
+        # Errors returned by the Calendar API. The status code is in error.resp.status
+        apiErrors = (CalendarApiError,)
+        # Network failures that skip a calendar instead of stopping the refresh. requests errors are OSErrors too
+        fetchErrors = (TimeoutError, OSError, TransportError)
+        return
+
+    from googleapiclient.discovery import build
+    from googleapiclient.errors import HttpError
+    from google_auth_httplib2 import AuthorizedHttp
+    import httplib2
+
+    apiErrors = (HttpError,)
+    fetchErrors = (TimeoutError, OSError, httplib2.HttpLib2Error)
+
+def importDisplayDriver():
+    global epd7in3f
+
+    from waveshare_epd import epd7in3f
+
+# Returns the display to draw on. "waveshare" is the real panel, "file" is the stand-in from fileepd.py that writes
+# the frames to resources/display-output and only pretends to take as long as the panel.
+def createDisplay(backend):
+    if backend == "file":
+        from fileepd import FileEPD
+        return FileEPD(os.path.join(resdir, fileDisplayDir), fileDisplayLatencyScale)
 
+    importDisplayDriver()
+    if useFastPanelTransfer:
+        from epdtransfer import FastEPD
+        return FastEPD(epd7in3f.EPD(), epd7in3f.epdconfig)
+    return epd7in3f.EPD()
+
+# Events are kept small, since there can be a lot of them with long horizons: no __dict__, calendar names are
+# interned so every event of a calendar shares one string, and the day and the sort key are worked out once, as
+# plain integers, when the event is made. Events are not meant to be changed after that.
 class PiCalendarEvent():
+    __slots__ = ("calendarName", "eventSummary", "allDayEventDate", "eventStartTime", "eventEndTime", "dayOrdinal",
+                 "sortKey")
+
     def __init__(self, calendarName, eventSummary, allDayEventDate, eventStartTime, eventEndTime):
-        self.calendarName = calendarName
+        self.calendarName = sys.intern(calendarName)
         self.allDayEventDate = allDayEventDate
         self.eventSummary = eventSummary
         self.eventStartTime = eventStartTime
         self.eventEndTime = eventEndTime
 
+        if allDayEventDate:
+            # All-day event: use the date, sort before timed events (0), time is midnight
+            self.dayOrdinal = allDayEventDate.toordinal()
+            self.sortKey = (self.dayOrdinal, 0, 0)
+        elif eventStartTime:
+            # Timed event: the date and the microsecond of the day
+            self.dayOrdinal = eventStartTime.toordinal()
+            secondOfDay = eventStartTime.hour * 3600 + eventStartTime.minute * 60 + eventStartTime.second
+            self.sortKey = (self.dayOrdinal, 1, secondOfDay * 1000000 + eventStartTime.microsecond)
+        else:
+            # No date info - sort these last
+            self.dayOrdinal = date.max.toordinal()
+            self.sortKey = (self.dayOrdinal, 2, 0)
+
     def get_sort_key(self):
         """
         Returns a tuple for sorting:
-        - Primary: the date (from either allDayEventDate or eventStartTime)
+        - Primary: the day (from either allDayEventDate or eventStartTime), as a date ordinal
         - Secondary: 0 for all-day events, 1 for timed events (so all-day comes first)
-        - Tertiary: time of day for timed events (midnight for all-day)
+        - Tertiary: microsecond of the day for timed events (0 for all-day)
         """
-        if self.allDayEventDate:
-            # All-day event: use the date, sort before timed events (0), time is midnight
-            return (self.allDayEventDate, 0, datetime.min.time())
-        elif self.eventStartTime:
-            # Timed event: extract date and time
-            return (self.eventStartTime.date(), 1, self.eventStartTime.time())
-        else:
-            # No date info - sort these last
-            return (date.max, 2, datetime.max.time())
+        return self.sortKey
 
-    # Gets the event date as a datetime string without the time component
-    def getDateNoTimeStr(self):
-        if self.allDayEventDate:
-            return self.allDayEventDate.strftime("%Y-%m-%d")
-        else:
-          return self.eventStartTime.strftime("%Y-%m-%d")
+    # Gets the day the event is drawn on. Events without a date go after every other day
+    def getDate(self):
+        return date.fromordinal(self.dayOrdinal)
+
+# Sort key of PiCalendarEvent, faster than calling get_sort_key
+getSortKey = operator.attrgetter("sortKey")
 
 # Takes in a date object and returns "Today", "Tomorrow", or the weekday
-def formatEventWeekday(eventDate):
+def formatEventWeekday(eventDate, now=None):
     weekdays = {}
     weekdays[0] = "Monday"
     weekdays[1] = "Tuesday"
@@ -144,8 +392,11 @@ def formatEventWeekday(eventDate):
     weekdays[5] = "Saturday"
     weekdays[6] = "Sunday"
 
-    today = datetime.now()
-    tomorrow = datetime.now() + timedelta(days=1)
+    if now is None:
+        now = datetime.now()
+
+    today = now
+    tomorrow = now + timedelta(days=1)
 
     if today.day == eventDate.day:
         return "Today"
@@ -176,105 +427,450 @@ def formatEventDateTime(eventDate):
 
     return f"{eventHour}{hourMinuteSeparator}{eventMinuteStr}{amPm}"
 
-def getRealEvents():
-    piEvents = []
-
-    # Get the current local time information
-    localTimeInfo = time.localtime()
-    isDst = localTimeInfo.tm_isdst
-
-    creds = None
+def loadCredentials(creds=None):
     # The file token.json stores the user's access and refresh tokens, and is
     # created automatically when the authorization flow completes for the first
     # time.
-    tokenFile = os.path.join(resdir, "token.json")
+    tokenText = getStateStore().readText("token.json")
     credentialsFile = os.path.join(resdir, "credentials.json")
 
-    if os.path.exists(tokenFile):
-      creds = Credentials.from_authorized_user_file(tokenFile, SCOPES)
+    if creds is None and tokenText is not None:
+      creds = Credentials.from_authorized_user_info(json.loads(tokenText), SCOPES)
     # If there are no (valid) credentials available, let the user log in.
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
             creds.refresh(Request())
         else:
+            # Only needed the first time, when the user has to log in through the browser
+            from google_auth_oauthlib.flow import InstalledAppFlow
             flow = InstalledAppFlow.from_client_secrets_file(credentialsFile, SCOPES)
             creds = flow.run_local_server(port=0)
 
-        # Save the credentials for the next run
-        with open(tokenFile, "w") as token:
-            token.write(creds.to_json())
+        # Save the credentials for the next run. The access token changes on every refresh, but the refresh token
+        # that matters after a reboot does not, so the file is hot
+        getStateStore().write("token.json", creds.to_json(), hot=True)
 
-    try:
-        service = build("calendar", "v3", credentials=creds)
+    return creds
 
-        # Call the Calendar API
-        now = datetime.now(tz=timezone.utc).isoformat()
+# Credentials and the calendar service are kept between refreshes when running as a daemon
+calendarCreds = None
+calendarService = None
+
+def getCalendarService():
+    global calendarCreds, calendarService
 
-        calendars_result = service.calendarList().list().execute()
-        calendars = calendars_result.get("items", [])
+    if calendarCreds is None or not calendarCreds.valid:
+        with metrics.stage("credentials"):
+            calendarCreds = loadCredentials(calendarCreds)
 
-        if not calendars:
-            print("No calendars found")
+    if calendarService is None:
+        with metrics.stage("build service"):
+            if useSlimCalendarClient:
+                from google.auth.transport.requests import AuthorizedSession
+                calendarService = buildSlimCalendarService(AuthorizedSession(calendarCreds))
+            else:
+                calendarService = build("calendar", "v3", credentials=calendarCreds)
+
+    return calendarCreds, calendarService
+
+# One session is shared by all fetch threads. Its connection pool keeps a connection open per thread. The session is
+# an AuthorizedSession for Google, or a plain requests.Session for a stand-in server (see fakecalendarapi.py)
+def buildSlimCalendarService(session):
+    from calendarclient import SlimCalendarService, SessionTransport
+    from requests.adapters import HTTPAdapter
+
+    for prefix in ("https://", "http://"):
+        session.mount(prefix, HTTPAdapter(pool_connections=1, pool_maxsize=max(fetchConcurrency, 1)))
+
+    def countResponse(contentLength):
+        metrics.count("api_calls")
+        metrics.count("bytes_received", contentLength)
+
+    return SlimCalendarService(SessionTransport(session, fetchTimeoutSeconds), calendarApiBaseUrl,
+                               onResponse=countResponse)
+
+# Counts the API calls and the bytes received through an httplib2 connection
+class CountingHttp():
+    def __init__(self, http):
+        self.http = http
+
+    def request(self, *args, **kwargs):
+        response, content = self.http.request(*args, **kwargs)
+        metrics.count("api_calls")
+        metrics.count("bytes_received", len(content))
+        return response, content
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
+
+# httplib2 connections are not thread safe, so every fetch thread gets its own authorized connection
+fetchThreadState = threading.local()
+
+def getThreadHttp(creds):
+    # The slim client has its own connection pool
+    if useSlimCalendarClient:
+        return None
+
+    http = getattr(fetchThreadState, "http", None)
+    if http is None:
+        http = CountingHttp(AuthorizedHttp(creds, http=httplib2.Http(timeout=fetchTimeoutSeconds)))
+        fetchThreadState.http = http
+    return http
+
+# Turns one event from the Google calendar API into a PiCalendarEvent
+def makePiCalendarEvent(calendarName, calendarTimeZone, event, isDst):
+    logging.debug("event=%s", event)
+    startDateTimeStr = event["start"].get("dateTime")
+    endDateTimeStr = event["end"].get("dateTime")
+
+    allDay = None
+    startDateTime = None
+    endDateTime = None
+    if startDateTimeStr is None:
+        allDay = datetime.fromisoformat(event["start"].get("date"))
+        allDay = allDay.date()
+    else:
+        startDateTime = datetime.fromisoformat(startDateTimeStr)
+        endDateTime = datetime.fromisoformat(endDateTimeStr)
+
+        # Handle when a calendar's time zone was set to UTC for some reason. All the events on the
+        # calendar have to be adjusted.
+        if calendarTimeZone == "UTC":
+            if isDst:
+                startDateTime = startDateTime + timedelta(hours=-7)
+                endDateTime = endDateTime + timedelta(hours=-7)
+            else:
+                startDateTime = startDateTime + timedelta(hours=-8)
+                endDateTime = endDateTime + timedelta(hours=-8)
+
+    return PiCalendarEvent(calendarName = calendarName,
+                           eventSummary = event["summary"],
+                           allDayEventDate = allDay,
+                           eventStartTime= startDateTime,
+                           eventEndTime = endDateTime)
+
+# Returns the end of the last day drawn by layoutEvents, or the end of the day days days ahead, as an ISO timestamp
+# with the local UTC offset
+def getDisplayHorizon(now=None, days=None):
+    if now is None:
+        now = datetime.now()
+    if days is None:
+        days = displayDays
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    return (today + timedelta(days=days)).astimezone().isoformat()
+
+# Returns the fetch policy of a calendar. What calendar-policies.txt leaves out is taken from main.py: fetched on every
+# refresh (refreshMinutes 0), displayDays days ahead and maxEventsPerCalendar events
+def getCalendarPolicy(calendarName):
+    settings = calendarPolicies.get(calendarName, {})
+    return CalendarPolicy(settings.get("refresh", 0), settings.get("days", displayDays),
+                          settings.get("events", maxEventsPerCalendar))
+
+# Whether something last fetched at fetchedEpoch (None for never) has to be fetched again
+def isFetchDue(fetchedEpoch, refreshMinutes, nowEpoch):
+    return fetchedEpoch is None or nowEpoch - fetchedEpoch >= refreshMinutes * 60
+
+# Lists the events of one calendar, one page at a time. The next page is only requested when the caller asks for
+# it, so a caller that stops early does not download the rest of the calendar.
+def iterEventPages(service, creds, calendar, params):
+    pageToken = None
+    while True:
+        pageParams = {"fields": eventFields}
+        pageParams.update(params, calendarId=calendar["id"])
+        if pageToken:
+            pageParams["pageToken"] = pageToken
+
+        with metrics.calendarStage(calendar["summary"]):
+            page = service.events().list(**pageParams).execute(http=getThreadHttp(creds))
+        yield page
+
+        pageToken = page.get("nextPageToken")
+        if not pageToken:
             return
 
+# Fetches the upcoming events for a single calendar, up to the end of the last day drawn. Runs on one of the fetch
+# threads
+def fetchCalendarEvents(service, creds, calendar, now, isDst):
+    calendarName = calendar["summary"]
+    logging.debug("\nCalendar id=%s, summary=%s\n------------" % (calendar["id"], calendarName))
+
+    policy = getCalendarPolicy(calendarName)
+
+    params = {"timeMin": now, "timeMax": getDisplayHorizon(days=policy.days), "singleEvents": True,
+              "orderBy": "startTime", "maxResults": min(policy.maxEvents or 25, 250)}
+
+    # Only the first page is downloaded here. The rest is downloaded when the layout gets that far
+    pages = iterEventPages(service, creds, calendar, params)
+    firstPage = next(pages)
+
+    if not firstPage.get("items"):
+        print(f"No upcoming events found for {calendarName}.")
+
+    # The events are taken out of each page, so the rest of the response can go as soon as the next page comes
+    eventPages = (page.pop("items", []) for page in itertools.chain([firstPage], pages))
+    return streamCalendarEvents(calendar, eventPages, isDst, policy.maxEvents)
+
+# Calendars whose policy has a refreshMinutes are downloaded in full and kept here between the refreshes of the
+# daemon, as {calendarId: (fetched epoch, events)}. The calendar list is kept in calendarListCache the same way.
+calendarEventCache = {}
+calendarListCache = None
+
+# Returns the events of one calendar: the kept copy while its policy says it is not due, otherwise the events from
+# the Calendar API. Runs on one of the fetch threads.
+def getCalendarEvents(service, creds, calendar, now, isDst):
+    policy = getCalendarPolicy(calendar["summary"])
+    if not policy.refreshMinutes:
+        return fetchCalendarEvents(service, creds, calendar, now, isDst)
+
+    nowEpoch = datetime.fromisoformat(now).timestamp()
+    cached = calendarEventCache.get(calendar["id"])
+    if cached is None or isFetchDue(cached[0], policy.refreshMinutes, nowEpoch):
+        cached = (nowEpoch, list(fetchCalendarEvents(service, creds, calendar, now, isDst)))
+        calendarEventCache[calendar["id"]] = cached
+    else:
+        metrics.count("calendars_cached")
+
+    return [event for event in cached[1] if event.eventEndTime is None or event.eventEndTime.timestamp() > nowEpoch]
+
+# Turns pages of events from the Calendar API into PiCalendarEvents, one page at a time. The pages come in start
+# time order, but the UTC fix in makePiCalendarEvent can move a timed event past an all day event, so every page is
+# sorted again before it is merged with the other calendars. Stops after maxEvents events.
+def streamCalendarEvents(calendar, eventPages, isDst, maxEvents=None):
+    eventCount = 0
+    try:
+        for events in eventPages:
+            piEvents = [makePiCalendarEvent(calendar["summary"], calendar["timeZone"], event, isDst) for event in events]
+            # Only the PiCalendarEvents are kept while they are laid out, not the events from the API
+            events = None
+            for piEvent in sorted(piEvents, key=getSortKey):
+                if maxEvents is not None and eventCount >= maxEvents:
+                    return
+                eventCount += 1
+                yield piEvent
+    except apiErrors + fetchErrors as error:
+        logging.warning(f"Could not download more events of {calendar['summary']}, the request failed: {error}")
+
+# Downloads what changed in one calendar since its last sync. Without a sync token, the calendar is downloaded from
+# scratch, from fullSyncStart to fullSyncEnd. Returns None when the sync token expired. Runs on one of the fetch
+# threads; the caller applies the changes to the store. The Calendar API does not accept timeMax together with a sync token, so changes after fullSyncEnd are stored
+# too and getStoredEvents only reads the events up to the end of the last day drawn.
+def syncCalendarEvents(service, creds, calendar, syncToken, fullSyncStart, fullSyncEnd, singleEvents=True):
+    fullSync = syncToken is None
+    changedEvents = []
+
+    params = {"singleEvents": singleEvents, "maxResults": 250}
+    if not singleEvents:
+        params["fields"] = recurringEventFields
+    if fullSync:
+        params["timeMin"] = fullSyncStart
+        params["timeMax"] = fullSyncEnd
+    else:
+        params["syncToken"] = syncToken
 
-        for calendar in calendars:
-            calendarName = calendar["summary"]
-            if calendarName in EXCLUDE_LIST:
+    try:
+        for page in iterEventPages(service, creds, calendar, params):
+            changedEvents.extend(page.get("items", []))
+    except apiErrors as error:
+        if error.resp.status == 410 and not fullSync:
+            # The sync token is no longer valid. The caller forgets it and starts over with a full sync
+            logging.info(f"Sync token expired for {calendar['summary']}, downloading the calendar again")
+            return None
+        raise
+
+    logging.debug(f"Synced {len(changedEvents)} changed events for {calendar['summary']}, fullSync={fullSync}")
+    return changedEvents, page.get("nextSyncToken"), fullSync
+
+# Brings the local event store up to date and returns an event stream for every calendar in it. When the Google
+# calendar API cannot be reached, the events from the last successful sync are used instead.
+def getStoredEvents(isDst):
+    expandRecurring = expandRecurringEvents and isRecurrenceAvailable()
+    store = EventStore(os.path.join(resdir, eventStoreFile), singleEvents=not expandRecurring)
+    try:
+        nowEpoch = int(time.time())
+        calendars = None
+        try:
+            calendars = store.getCalendars()
+            listSyncedEpoch = store.getSetting("calendarListSyncedEpoch")
+            if listSyncedEpoch is not None:
+                listSyncedEpoch = int(listSyncedEpoch)
+
+            if not calendars or isFetchDue(listSyncedEpoch, calendarListRefreshMinutes, nowEpoch):
+                creds, service = getCalendarService()
+                with metrics.stage("calendarList"):
+                    calendars_result = service.calendarList().list().execute(http=getThreadHttp(creds))
+                calendars = calendars_result.get("items", [])
+                store.saveCalendars(calendars)
+                store.setSetting("calendarListSyncedEpoch", nowEpoch)
+            else:
+                metrics.count("calendar_list_cached")
+
+            # Only the calendars whose policy says they are due are synced, the others are drawn from the store
+            calendars = [calendar for calendar in calendars if calendar["summary"] not in EXCLUDE_LIST]
+            syncTimes = store.getSyncTimes()
+            dueCalendars = [calendar for calendar in calendars if isFetchDue(
+                syncTimes.get(calendar["id"]), getCalendarPolicy(calendar["summary"]).refreshMinutes, nowEpoch)]
+            metrics.count("calendars_cached", len(calendars) - len(dueCalendars))
+            calendars = dueCalendars
+            if calendars:
+                creds, service = getCalendarService()
+        except (TransportError,) + apiErrors + fetchErrors as error:
+            logging.warning(f"Could not reach the Google calendar API, drawing the last synced events: {error}")
+            calendars = None
+
+        if calendars:
+            fullSyncStart = (datetime.now(tz=timezone.utc) - timedelta(days=1)).isoformat()
+            fullSyncEnd = getDisplayHorizon(days=max(fullSyncDays, displayDays))
+            fullSyncEndEpoch = int(datetime.fromisoformat(fullSyncEnd).timestamp())
+
+            # A calendar whose last full sync does not reach the last day drawn any more is downloaded again
+            syncHorizons = store.getSyncHorizons()
+            syncTokens = []
+            for calendar in calendars:
+                syncToken = store.getSyncToken(calendar["id"])
+                if syncHorizons.get(calendar["id"], 0) < getHorizonEpoch(calendar):
+                    syncToken = None
+                syncTokens.append(syncToken)
+
+            with ThreadPoolExecutor(max_workers=max(1, fetchConcurrency)) as executor:
+                futures = [executor.submit(syncCalendarEvents, service, creds, calendar, syncToken, fullSyncStart,
+                                           fullSyncEnd, not expandRecurring)
+                           for calendar, syncToken in zip(calendars, syncTokens)]
+
+                for index, calendar in enumerate(calendars):
+                    # The downloaded events of a calendar are let go once they are in the store, instead of keeping
+                    # the responses of every calendar until the last one is stored
+                    future = futures[index]
+                    futures[index] = None
+                    try:
+                        syncResult = future.result()
+                        if syncResult is None:
+                            # The expired token is forgotten first, so when the full sync fails too, the next refresh
+                            # does not try the old token again
+                            store.resetSyncToken(calendar["id"])
+                            syncResult = executor.submit(syncCalendarEvents, service, creds, calendar, None,
+                                                         fullSyncStart, fullSyncEnd, not expandRecurring).result()
+                        changedEvents, nextSyncToken, fullSync = syncResult
+                        syncResult = None
+                    except apiErrors + fetchErrors as error:
+                        logging.warning(f"Could not sync calendar {calendar['summary']}, drawing its last synced events: {error}")
+                        continue
+                    finally:
+                        future = None
+
+                    store.applyChanges(calendar["id"], changedEvents, nextSyncToken, fullSync, nowEpoch,
+                                       fullSyncEndEpoch if fullSync else None)
+                    changedEvents = None
+
+            store.pruneEndedEvents(int(time.time()) - 86400)
+
+        eventStreams = []
+        for calendar in store.getCalendars():
+            if calendar["summary"] in EXCLUDE_LIST:
                 continue
 
-            logging.debug("\nCalendar id=%s, summary=%s\n------------" % (calendar["id"], calendarName))
-            calendarTimeZone = calendar["timeZone"]
+            # The store can hold events past the horizon of a calendar, they are left out when its events are read
+            policy = getCalendarPolicy(calendar["summary"])
+            horizonEpoch = getHorizonEpoch(calendar)
+            storedEvents = store.getUpcomingEvents(calendar["id"], policy.maxEvents, beforeEpoch=horizonEpoch)
+            if expandRecurring:
+                storedEvents = addRecurringEvents(store, calendar["id"], storedEvents, horizonEpoch, policy.maxEvents)
+            eventStreams.append(streamCalendarEvents(calendar, pageStoredEvents(storedEvents), isDst))
+
+        return eventStreams
+    finally:
+        store.close()
+
+# Returns the end of the last day drawn for a calendar, in epoch seconds
+def getHorizonEpoch(calendar):
+    policy = getCalendarPolicy(calendar["summary"])
+    return int(datetime.fromisoformat(getDisplayHorizon(days=min(policy.days, displayDays))).timestamp())
+
+# Hands out stored events in pages of storedEventPageSize, like the pages of the Calendar API, so streamCalendarEvents
+# only turns them into PiCalendarEvents as far as the layout reads
+def pageStoredEvents(storedEvents):
+    for start in range(0, len(storedEvents), storedEventPageSize):
+        yield storedEvents[start:start + storedEventPageSize]
+
+def isRecurrenceAvailable():
+    import recurrence
+    if not recurrence.isAvailable():
+        logging.warning("python-dateutil is not installed, downloading every occurrence of recurring events instead")
+        return False
+    return True
+
+# Adds the occurrences of the recurring events of a calendar to its stored events, keeping the start time order and
+# at most maxEvents events. Occurrences are worked out for whole days, from the start of today, so the expansion of an
+# unchanged recurring event is reused by every refresh of the day.
+def addRecurringEvents(store, calendarId, storedEvents, horizonEpoch, maxEvents):
+    import recurrence
+
+    nowEpoch = int(time.time())
+    todayEpoch = int(datetime.combine(date.today(), datetime.min.time()).timestamp())
+    with metrics.stage("expand recurring events"):
+        instances = recurrence.expandRecurringEvents(store.getRecurringEvents(calendarId),
+                                                     store.getRecurrenceExceptions(calendarId), todayEpoch, horizonEpoch)
+    if not instances:
+        return storedEvents
+
+    events = storedEvents + [instance for instance in instances if getEventEpoch(instance["end"]) > nowEpoch]
+    events.sort(key=lambda event: getEventEpoch(event["start"]))
+    metrics.count("recurring_occurrences", len(instances))
+    return events[:maxEvents] if maxEvents is not None else events
+
+# Returns an event stream for every calendar, see streamCalendarEvents
+def getRealEvents():
+    global calendarListCache
+    eventStreams = []
 
-            events_result = service.events().list(calendarId=calendar["id"],
-              timeMin=now,
-              maxResults=10,
-              singleEvents=True,
-              orderBy="startTime",
-            ).execute()
+    # Get the current local time information
+    localTimeInfo = time.localtime()
+    isDst = localTimeInfo.tm_isdst
 
-            events = events_result.get("items", [])
+    importGoogleLibraries()
 
-            if not events:
-                print("No upcoming events found.")
-            else:
-                for event in events:
-                    logging.debug(f"event={str(event)}")
-                    startDateTimeStr = event["start"].get("dateTime")
-                    endDateTimeStr = event["end"].get("dateTime")
-
-                    allDay = None
-                    startDateTime = None
-                    endDateTime = None
-                    if startDateTimeStr is None:
-                        allDay = datetime.fromisoformat(event["start"].get("date"))
-                        allDay = allDay.date()
-                    else:
-                        startDateTime = datetime.fromisoformat(startDateTimeStr)
-                        endDateTime = datetime.fromisoformat(endDateTimeStr)
-
-                        # Handle when a calendar's time zone was set to UTC for some reason. All the events on the
-                        # calendar have to be adjusted.
-                        if calendarTimeZone == "UTC":
-                            if isDst:
-                                startDateTime = startDateTime + timedelta(hours=-7)
-                                endDateTime = endDateTime + timedelta(hour=-7)
-                            else:
-                                startDateTime = startDateTime + timedelta(hours=-8)
-                                endDateTime = endDateTime + timedelta(hours=-8)
-
-                    piEvent = PiCalendarEvent(calendarName = calendar["summary"],
-                                                eventSummary = event["summary"],
-                                                allDayEventDate = allDay,
-                                                eventStartTime= startDateTime,
-                                                eventEndTime = endDateTime)
-
-                    piEvents.append(piEvent)
-    except HttpError as error:
-        print(f"An HTTP occurred: {error}")
-        exit(1)
+    if useEventStore:
+        return getStoredEvents(isDst)
 
-    return piEvents
+    try:
+        creds, service = getCalendarService()
+
+        # Call the Calendar API
+        now = datetime.now(tz=timezone.utc).isoformat()
+        nowEpoch = time.time()
+
+        if calendarListCache is not None and not isFetchDue(calendarListCache[0], calendarListRefreshMinutes, nowEpoch):
+            calendars = calendarListCache[1]
+            metrics.count("calendar_list_cached")
+        else:
+            with metrics.stage("calendarList"):
+                calendars_result = service.calendarList().list().execute(http=getThreadHttp(creds))
+            calendars = calendars_result.get("items", [])
+            calendarListCache = (nowEpoch, calendars)
+    except apiErrors as error:
+        # Leave it to the caller: a run from cron ends, the daemon keeps the last frame and tries again later
+        logging.warning(f"Could not get the list of calendars, an HTTP error occurred: {error}")
+        raise
+
+    if not calendars:
+        print("No calendars found")
+        return eventStreams
+
+    calendars = [calendar for calendar in calendars if calendar["summary"] not in EXCLUDE_LIST]
+
+    # Fetch the first page of every calendar in parallel. Results are collected in calendarList order so the output
+    # does not depend on which calendar answered first. A calendar that fails or times out is skipped for this refresh.
+    with ThreadPoolExecutor(max_workers=max(1, fetchConcurrency)) as executor:
+        futures = [executor.submit(getCalendarEvents, service, creds, calendar, now, isDst) for calendar in calendars]
+
+        for calendar, future in zip(calendars, futures):
+            try:
+                eventStreams.append(future.result())
+            except apiErrors as error:
+                logging.warning(f"Skipping calendar {calendar['summary']}, an HTTP error occurred: {error}")
+            except fetchErrors as error:
+                logging.warning(f"Skipping calendar {calendar['summary']}, the request failed: {error}")
+
+    return eventStreams
 
 def generateFakeEvents():
     piEvents = []
@@ -368,111 +964,112 @@ def generateFakeEvents():
     piEvents.append(piEvent)
     return piEvents
 
-def drawDayHeader(draw, dayNumText, dayText, eventOriginX, eventOriginY):
+# The layout functions below decide where everything goes on the frame and add it to a display list (see
+# displaylist.py). Nothing is drawn until the display list is passed to drawDisplayList.
+def layoutDayHeader(displayList, dayNumText, dayText, eventOriginX, eventOriginY):
     # Current day number
-    draw.text((eventOriginX, eventOriginY-10), dayNumText, font = dayNumFont, fill = epd_BLACK)
+    displayList.append(TextItem(eventOriginX, eventOriginY-10, dayNumText, dayNumFont, epd_BLACK))
 
     # Current day
-    draw.text((eventOriginX+70, eventOriginY+2), dayText, font = dayFont, fill = epd_BLACK)
+    displayList.append(TextItem(eventOriginX+70, eventOriginY+2, dayText, dayFont, epd_BLACK))
 
     # Horizontal line between the day text and the first event
-    draw.line((eventOriginX, eventOriginY+35, maxX, eventOriginY+35), width = 2, fill = epd_BLACK)
+    displayList.append(LineItem(eventOriginX, eventOriginY+35, maxX, eventOriginY+35, 2, epd_BLACK))
 
-def drawEvent(draw, eventOriginX, eventOriginY, color, timeText, line1Text, line2Text):
+def layoutEvent(displayList, eventOriginX, eventOriginY, color, timeText, line1Text, line2Text):
     # large event rectangle. 440 wide by 45 high
-    draw.rounded_rectangle((eventOriginX, eventOriginY+45, maxX, eventOriginY+90), fill=color, outline=color, width=2, \
-corners=((eventOriginX,eventOriginY+45), (maxX, eventOriginY+45), (eventOriginX, eventOriginY+90), (maxX, eventOriginY+90)), radius=8)
+    displayList.append(BoxItem(eventOriginX, eventOriginY+45, maxX, eventOriginY+90, 8, color))
 
     textColor = epd_WHITE
     if color == epd_YELLOW or color == epd_ORANGE:
         textColor = epd_BLACK
 
     # event time
-    draw.text((eventOriginX+25, eventOriginY+60), timeText, font = eventFont, fill = textColor)
+    displayList.append(TextItem(eventOriginX+25, eventOriginY+60, timeText, eventFont, textColor))
 
     if line2Text is not None:
         # event description
-        draw.text((eventOriginX+190, eventOriginY+50), line1Text, font = eventFont, fill = textColor)
+        displayList.append(TextItem(eventOriginX+190, eventOriginY+50, line1Text, eventFont, textColor))
 
         # event description 2
-        draw.text((eventOriginX+190, eventOriginY+70), line2Text, font = eventFont, fill = textColor)
+        displayList.append(TextItem(eventOriginX+190, eventOriginY+70, line2Text, eventFont, textColor))
     else:
-        draw.text((eventOriginX+190, eventOriginY+60), line1Text, font = eventFont, fill = textColor)
-
-def drawNoEvents(draw, eventOriginX, eventOriginY):
-    draw.text((eventOriginX+30, eventOriginY+60), "No events", font = eventFont, fill = epd_BLACK)
+        displayList.append(TextItem(eventOriginX+190, eventOriginY+60, line1Text, eventFont, textColor))
 
-def maybeSplitEventSummary(eventSummary):
-    parts = eventSummary.split()
+def layoutNoEvents(displayList, eventOriginX, eventOriginY):
+    displayList.append(TextItem(eventOriginX+30, eventOriginY+60, "No events", eventFont, epd_BLACK))
 
-    truncatedMsg = ""
-    truncatedMsg2 = ""
-    useTruncated2 = False
+# Splits the event summary over two lines where the first line runs out of room, measured with the real width of
+# the text. Summaries that do not fit on two lines end with an ellipsis.
+def maybeSplitEventSummary(eventSummary, eventOriginX=originX):
+    maxWidth = maxX - eventSummaryPaddingRight - (eventOriginX + 190)
+    lines = textMeasurer.wrapText(eventFont, eventSummary, maxWidth, 2)
 
-    for word in parts:
-        if (len(truncatedMsg) + len(word) + 1) > eventCharLimit:
-            useTruncated2 = True
-
-        if useTruncated2:
-            truncatedMsg2 += f"{word} "
-        else:
-            truncatedMsg += f"{word} "
+    while len(lines) < 2:
+        lines.append("")
 
-    truncatedMsg = truncatedMsg.strip()
-    truncatedMsg2 = truncatedMsg2.strip()
-
-    return [truncatedMsg, truncatedMsg2]
+    return lines
 
+# Sorts events by date and then by time. All day events are sorted first in each day
 def sortEvents(piEvents):
-    sortedEvents = sorted(piEvents, key=lambda e: e.get_sort_key())
-
-    eventsByDay = {}
-    for event in sortedEvents:
-        dateStr = event.getDateNoTimeStr()
-        dailyEvents = None
-
-        if dateStr in eventsByDay:
-            dailyEvents = eventsByDay[dateStr]
-        else:
-            dailyEvents = []
-
-        dailyEvents.append(event)
-        eventsByDay[dateStr] = dailyEvents
-
-    return eventsByDay
-
-def drawEvents(draw, eventsByDay, eventOriginX, eventOriginY):
-    now = datetime.now()
-    for i in range(0, 10):
+    return sorted(piEvents, key=getSortKey)
+
+# Merges the event streams of all calendars into one stream in the order of sortEvents. Every stream has to be in
+# that order already. The merge is lazy: the next event of a calendar is only taken when it is needed.
+def mergeEventStreams(eventStreams):
+    return heapq.merge(*eventStreams, key=getSortKey)
+
+# Passes the events through and keeps the ones that were used in usedEvents
+def recordEvents(events, usedEvents):
+    for event in events:
+        usedEvents.append(event)
+        yield event
+
+# Lays out the events of the next 10 days, until the frame is full. Returns the display list. events has to be in the
+# order of sortEvents, and is only read as far as the frame has room for.
+def layoutEvents(events, eventOriginX, eventOriginY, now=None):
+    if now is None:
+        now = datetime.now()
+
+    events = iter(events)
+    nextEvent = next(events, None)
+
+    displayList = []
+    for i in range(0, displayDays):
         # First, calculate where there is enough room for both the header and 1 event
         proposedHeight = eventOriginY + dayHeaderHeight + eventSpacer + eventHeight + eventSpacer
         logging.debug(f"Processing day {i}")
         logging.debug(f"eventOriginY={eventOriginY}, dayHeaderHeight={dayHeaderHeight}, eventSpacer={eventSpacer}, eventHeight={eventHeight}, proposedHeight={proposedHeight}. maxY={maxY}")
         if proposedHeight > maxY:
             logging.debug("No more room for header + an event, exiting now")
-            return
+            return tuple(displayList)
 
         currentDay = (now + timedelta(days=i))
-        currentDayStr = currentDay.strftime("%Y-%m-%d")
+        currentDate = currentDay.date()
 
-        drawDayHeader(draw, str(currentDay.day), formatEventWeekday(currentDay), eventOriginX, eventOriginY)
+        layoutDayHeader(displayList, str(currentDay.day), formatEventWeekday(currentDay, now), eventOriginX, eventOriginY)
 
-        logging.info(f"\n{currentDay.day}    {formatEventWeekday(currentDay)}")
+        logging.info(f"\n{currentDay.day}    {formatEventWeekday(currentDay, now)}")
         logging.info("--------------------------------------------------------------------")
 
-        if currentDayStr in eventsByDay:
-            dailyEvents = eventsByDay[currentDayStr]
+        # Events that started before this day are not drawn
+        currentDayOrdinal = currentDate.toordinal()
+        while nextEvent is not None and nextEvent.dayOrdinal < currentDayOrdinal:
+            nextEvent = next(events, None)
+
+        if nextEvent is not None and nextEvent.dayOrdinal == currentDayOrdinal:
+            while nextEvent is not None and nextEvent.dayOrdinal == currentDayOrdinal:
+                event = nextEvent
 
-            for event in dailyEvents:
                 # Calculate where there is enough room for another event
-                logging.debug(f"Processing event {event.eventSummary} on day {event.getDateNoTimeStr()}")
+                logging.debug(f"Processing event {event.eventSummary} on day {currentDate}")
                 proposedHeight = eventOriginY + eventSpacer + eventHeight + eventSpacer
                 logging.debug(f"eventOriginY={eventOriginY}, eventSpacer={eventSpacer}, proposedHeight={proposedHeight}. maxY={maxY}\n")
                 if proposedHeight > maxY:
                     logging.debug("No more room for any more events, exiting now")
-                    return
+                    return tuple(displayList)
 
-                summaryTruncated = maybeSplitEventSummary(event.eventSummary)
+                summaryTruncated = maybeSplitEventSummary(event.eventSummary, eventOriginX)
                 summaryFirstLine = summaryTruncated[0]
                 summarySecondLine = None
 
@@ -481,23 +1078,29 @@ def drawEvents(draw, eventsByDay, eventOriginX, eventOriginY):
 
                 color = colorMap.get(event.calendarName, epd_BLACK)
                 if event.allDayEventDate:
-                    drawEvent(draw, eventOriginX, eventOriginY, color, "All day", summaryFirstLine, summarySecondLine)
+                    layoutEvent(displayList, eventOriginX, eventOriginY, color, "All day", summaryFirstLine, summarySecondLine)
                     logging.info(f"All day - {event.eventSummary}, color={color}")
                 else:
                     timeStr = f"{formatEventDateTime(event.eventStartTime)} - {formatEventDateTime(event.eventEndTime)}"
-                    drawEvent(draw, eventOriginX, eventOriginY, color, timeStr, summaryFirstLine, summarySecondLine)
+                    layoutEvent(displayList, eventOriginX, eventOriginY, color, timeStr, summaryFirstLine, summarySecondLine)
                     logging.info(f"{formatEventDateTime(event.eventStartTime)} - {formatEventDateTime(event.eventEndTime)} {event.eventSummary}, color={color}")
 
                 eventOriginY = eventOriginY + eventHeight + eventSpacer
+                nextEvent = next(events, None)
 
         else:
-            drawNoEvents(draw, eventOriginX, eventOriginY)
+            layoutNoEvents(displayList, eventOriginX, eventOriginY)
             logging.info("No events")
             eventOriginY = eventOriginY + eventHeight + eventSpacer
 
 
         eventOriginY = eventOriginY + dayHeaderHeight + eventSpacer
 
+    return tuple(displayList)
+
+def drawEvents(draw, events, eventOriginX, eventOriginY):
+    drawDisplayList(draw, layoutEvents(events, eventOriginX, eventOriginY), drawText, getInk, getFont)
+
 def get_interface_ip_address(ifname):
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     return socket.inet_ntoa(fcntl.ioctl(
@@ -507,31 +1110,100 @@ def get_interface_ip_address(ifname):
     )[20:24])
 
 
-def loadDrawCalendars(draw, originX, originY):
-    piEvents = []
+# Reads the fingerprint and time of the last refresh from resources/last-frame.txt
+def readLastFrame():
+    lastFrame = {}
+    frameText = getStateStore().readText(lastFrameFile)
+    if frameText is not None:
+        for line in frameText.splitlines():
+            parts = line.strip().split("=")
+            if len(parts) == 2:
+                lastFrame[parts[0]] = parts[1]
 
-    if makeFakeEvents:
-        piEvents = generateFakeEvents()
-    else:
-        piEvents = getRealEvents()
+    return lastFrame
+
+def saveLastFrame(fingerprint):
+    getStateStore().write(lastFrameFile, f"fingerprint={fingerprint}\nrefreshed={int(time.time())}\n", hot=True)
+
+def isRefreshNeeded(fingerprint):
+    if not skipUnchangedFrames:
+        return True
 
-    # Sort all the events by date and then by time. All day events are sorted first in each day
-    eventsByDay = sortEvents(piEvents)
+    lastFrame = readLastFrame()
+    if lastFrame.get("fingerprint") != fingerprint:
+        return True
 
+    return isForcedRefreshDue(lastFrame)
+
+# Redraw an unchanged frame every now and then to clear ghosting on the panel
+def isForcedRefreshDue(lastFrame):
+    if forceRefreshHours:
+        lastRefreshed = int(lastFrame.get("refreshed", 0))
+        if time.time() - lastRefreshed >= forceRefreshHours * 3600:
+            logging.info(f"Forcing a refresh, the screen has not been redrawn for {forceRefreshHours} hours")
+            return True
+
+    return False
+
+# Lays out the footer below the events. It is kept apart from the events, since the "Last updated" time changes on
+# every run even when the events do not.
+def layoutFooter(originX, now=None):
+    if now is None:
+        now = datetime.now()
+
+    lastUpdated = f"Last updated: {now.strftime('%m/%d %H:%M')}"
+    try:
+        ipAddr = get_interface_ip_address('wlan0')
+    except OSError:
+        # No wireless interface, for example when rendering panels on a server (see panels.py)
+        ipAddr = ""
+
+    return (TextItem(originX, maxY+5, lastUpdated, updatedFont, epd_BLACK, cached=False),
+            TextItem(originX + 250, maxY+5, ipAddr, updatedFont, epd_GREEN))
+
+# Returns one event stream per calendar, each in the order of sortEvents
+def loadCalendarEvents():
+    with metrics.stage("load events"):
+        if makeFakeEvents:
+            return [EventIndex(generateFakeEvents())]
+        else:
+            return getRealEvents()
+
+# Merges the calendars and lays them out until the frame is full. Events past that point are never downloaded or
+# parsed. Returns the display list and the events that were read. When lookaheadEvents is a list, up to
+# precomputeLookahead + 1 of the events past the frame are added to it, for the frames drawn ahead of time; fewer
+# means there are no more events.
+def layoutCalendars(eventStreams, originX, originY, lookaheadEvents=None):
+    piEvents = []
+    mergedEvents = mergeEventStreams(eventStreams)
+    displayList = layoutEvents(recordEvents(mergedEvents, piEvents), originX, originY)
+    metrics.count("events_loaded", len(piEvents))
+
+    if lookaheadEvents is not None:
+        lookaheadEvents.extend(itertools.islice(mergedEvents, precomputeLookahead + 1))
+    return displayList, piEvents
+
+def loadDrawCalendars(draw, originX, originY):
     # Process events for the next 10 days
-    drawEvents(draw, eventsByDay, originX, originY)
+    displayList, piEvents = layoutCalendars(loadCalendarEvents(), originX, originY)
+    drawDisplayList(draw, displayList + layoutFooter(originX), drawText, getInk, getFont)
     logging.debug("All events have been drawn")
 
-    updatedFont = ImageFont.truetype(os.path.join(resdir, 'Font.ttc'), 16)
-    now = datetime.now()
-    lastUpdated = f"Last updated: {now.strftime("%m/%d %H:%M")}"
-    draw.text((originX , maxY+5), lastUpdated, font = updatedFont, fill = epd_BLACK)
+    return piEvents
 
-    ipAddr = get_interface_ip_address('wlan0')
-    draw.text((originX + 250, maxY+5), ipAddr, font = updatedFont, fill = epd_GREEN)
+# Returns the path of a config file in configDir. A panel profile (see panels.py) can leave a file out to use the
+# one in resources instead.
+def getConfigFilePath(configDir, fileName):
+    if configDir is not None and os.path.exists(os.path.join(configDir, fileName)):
+        return os.path.join(configDir, fileName)
+    return os.path.join(resdir, fileName)
 
-def main():
-    colorFilePath = os.path.join(resdir, 'color-map.txt')
+# Reads color-map.txt, calendar-policies.txt and excludes.txt from configDir, resources by default. Replaces what was loaded before
+def loadConfigFiles(configDir=None):
+    colorMap.clear()
+    EXCLUDE_LIST.clear()
+
+    colorFilePath = getConfigFilePath(configDir, 'color-map.txt')
     try:
         with open(colorFilePath, "r") as colorFile:
             for line in colorFile:
@@ -566,7 +1238,34 @@ def main():
         print(f"An error occurred: {e}")
         exit(1)
 
-    excludeFilePath = os.path.join(resdir, 'excludes.txt')
+    # calendar-policies.txt is optional. Each line is a calendar name and its policy, for example
+    #     Holidays in United States=refresh:1440 days:30 events:3
+    # refresh is in minutes, days is how far ahead to fetch and events is the most events shown, or "all"
+    calendarPolicies.clear()
+    policyFilePath = getConfigFilePath(configDir, 'calendar-policies.txt')
+    try:
+        with open(policyFilePath, "r") as policyFile:
+            for line in policyFile:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+
+                calendarName, policyText = line.rsplit("=", 1)
+                settings = {}
+                for setting in policyText.split():
+                    name, value = setting.split(":")
+                    if name not in ("refresh", "days", "events"):
+                        raise ValueError(f"Unknown setting {name} for {calendarName}")
+                    settings[name] = None if name == "events" and value == "all" else int(value)
+                calendarPolicies[calendarName.strip()] = settings
+
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"An error occurred in {policyFilePath}: {e}")
+        exit(1)
+
+    excludeFilePath = getConfigFilePath(configDir, 'excludes.txt')
     try:
         with open(excludeFilePath, "r") as excludeFile:
             for line in excludeFile:
@@ -574,36 +1273,472 @@ def main():
                 EXCLUDE_LIST.append(line)
 
     except FileNotFoundError:
-        print(f"Error: The file {colorFilePath} was not found.")
+        print(f"Error: The file {excludeFilePath} was not found.")
         exit(1)
     except Exception as e:
         print(f"An error occurred: {e}")
         exit(1)
 
+# Draws the calendar and sends it to the panel when it changed. When precomputed is a PrecomputedFrames, the frames
+# of the coming changes are drawn into it afterwards. Returns the events that were loaded.
+def refreshDisplay(epd, precomputed=None):
+    metrics.reset()
     try:
-        epd = epd7in3f.EPD()
-        logging.debug("Clearing screen...")
-        epd.init()
+        return drawRefresh(epd, precomputed)
+    finally:
+        writeRunMetrics()
 
-        logging.debug("Clear complete")
+def drawRefresh(epd, precomputed=None):
+    # A frame that is drawn no matter what can wake the panel right away, while the calendars are fetched
+    panelInit = None
+    if pipelinePanelInit and (not skipUnchangedFrames or isForcedRefreshDue(readLastFrame())):
+        panelInit = startPanelInit(epd)
 
-        # https://pillow.readthedocs.io/en/stable/reference/ImageDraw.html
-        # Draw on the Image. Use (epd.width, epd.height) for landscape mode. Use (epd.height, epd.width) for portrait mode.
-        # In portrait mode, width = 480, height = 800. (0, 0) is at the top left of the image.
-        Himage = Image.new('RGB', (epd.height, epd.width), epd.WHITE)  # 255: clear the frame
+    try:
+        eventStreams = loadCalendarEvents()
+        lookaheadEvents = [] if precomputed is not None else None
+
+        # The calendars are merged while they are laid out, so the layout stage includes any page downloaded on the
+        # way
+        with metrics.stage("layout"):
+            displayList, piEvents = layoutCalendars(eventStreams, originX, originY, lookaheadEvents)
+        metrics.count("events_drawn", sum(1 for item in displayList if type(item) is BoxItem))
+
+        # The panel is only woken up when the calendar actually looks different from what is already on screen. The
+        # display list tells, so an unchanged calendar is not even drawn.
+        fingerprint = getDisplayListFingerprint(displayList)
+        if isRefreshNeeded(fingerprint):
+            if pipelinePanelInit and panelInit is None:
+                panelInit = startPanelInit(epd)
+            panelBuffer = renderPanelBuffer(epd, displayList)
+            showPanelBuffer(epd, panelBuffer, panelInit)
+            saveLastFrame(fingerprint)
+        else:
+            logging.info("Calendar has not changed since the last refresh, leaving the screen as it is")
+            metrics.count("refresh_skipped")
+            if panelInit is not None:
+                stopPanel(epd, panelInit)
+        panelInit = None
+    finally:
+        # Fetching or drawing failed while the panel was waking up
+        if panelInit is not None:
+            stopPanel(epd, panelInit)
+
+    # The screen is done, so the time until the next change is idle anyway
+    if precomputed is not None:
+        with metrics.stage("precompute frames"):
+            updatePrecomputedFrames(epd, precomputed, piEvents, lookaheadEvents)
+
+    return piEvents
+
+# Draws the display list and the footer and returns the packed panel buffer. now is the time in the footer
+def renderPanelBuffer(epd, displayList, now=None):
+    # https://pillow.readthedocs.io/en/stable/reference/ImageDraw.html
+    # Draw on the Image. Use (epd.width, epd.height) for landscape mode. Use (epd.height, epd.width) for portrait mode.
+    # In portrait mode, width = 480, height = 800. (0, 0) is at the top left of the image.
+    frameList = displayList + layoutFooter(originX, now)
+    if lowMemoryMode and renderPanelColors:
+        # Whatever fetching left in reference cycles is freed before the frame is drawn
+        gc.collect()
+        with metrics.stage("draw bands"):
+            return renderPanelBands((epd.height, epd.width), epd.width, epd.height, renderBandRows,
+                                    lambda image, left, top: drawPanelBand(image, left, top, frameList))
+
+    with metrics.stage("draw"):
+        if renderPanelColors:
+            Himage = newPanelImage((epd.height, epd.width))  # white panel code: clear the frame
+        else:
+            Himage = Image.new('RGB', (epd.height, epd.width), epd.WHITE)  # 255: clear the frame
         draw = ImageDraw.Draw(Himage)
 
-        loadDrawCalendars(draw, originX, originY)
+        drawDisplayList(draw, frameList, drawText, getInk, getFont)
+    logging.debug("All events have been drawn")
 
-        epd.display(epd.getbuffer(Himage))
+    with metrics.stage("getbuffer"):
+        if renderPanelColors:
+            panelBuffer = packPanelBuffer(Himage, epd.width, epd.height)
+        else:
+            panelBuffer = epd.getbuffer(Himage)
+
+    return panelBuffer
+
+# Draws the part of a display list that falls on image, a band of the frame that starts at (left, top). See
+# renderPanelBands
+def drawPanelBand(image, left, top, displayList):
+    width, height = image.size
+    bandItems = clipDisplayList(displayList, left, top, left + width, top + height, getTextBounds)
+    drawDisplayList(ImageDraw.Draw(image), bandItems, drawText, getInk, getFont)
+
+# Returns a box that holds every pixel a TextItem can draw. Glyphs can reach a little past their advance width and
+# above the ascent, so the box has a margin
+def getTextBounds(item):
+    ascent, descent = getFont(item.font).getmetrics()
+    margin = ascent // 4 + 1
+    width = textMeasurer.getTextWidth(item.font, item.text)
+    return (item.x - margin, item.y - margin, item.x + width + margin, item.y + ascent + descent + margin)
+
+# Wakes the panel and sends it a frame. panelInit is what startPanelInit returned, when the panel is already waking
+def showPanelBuffer(epd, panelBuffer, panelInit=None):
+    if panelInit is None:
+        initPanel(epd)
+    else:
+        with metrics.stage("epd.init wait"):
+            panelInit.result()
+
+    with metrics.stage("epd.display"):
+        epd.display(panelBuffer)
+    with metrics.stage("epd.sleep"):
+        epd.sleep()
+
+def initPanel(epd):
+    logging.debug("Clearing screen...")
+    with metrics.stage("epd.init"):
+        epd.init()
+    logging.debug("Clear complete")
+
+panelInitExecutor = None
+
+# Starts epd.init on the panel thread and returns its Future (see pipelinePanelInit)
+def startPanelInit(epd):
+    global panelInitExecutor
+
+    if panelInitExecutor is None:
+        panelInitExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="panel-init")
+    return panelInitExecutor.submit(initPanel, epd)
+
+# Puts a panel that was woken by startPanelInit back to sleep without showing anything, after the refresh failed or
+# the frame turned out unchanged. epd.sleep ends with epdconfig.module_exit; when the panel never woke up properly,
+# module_exit is called directly so the SPI bus and GPIO pins are released either way.
+def stopPanel(epd, panelInit):
+    try:
+        panelInit.result()
         epd.sleep()
+    except Exception as e:
+        logging.warning(f"Could not put the panel to sleep: {e}")
+        if epd7in3f is not None:
+            epd7in3f.epdconfig.module_exit(cleanup=True)
+
+# Server mode: lays out the calendar like drawRefresh and stores the packed buffer in frameStore as the frame
+# "default". The ETag of the frame is the fingerprint of its layout, so it only changes when the calendar looks
+# different. renderer is only used for its size and getbuffer(), it is never shown. Returns the events that were loaded.
+def serveRefresh(renderer, frameStore):
+    eventStreams = loadCalendarEvents()
+
+    with metrics.stage("layout"):
+        displayList, piEvents = layoutCalendars(eventStreams, originX, originY)
+    metrics.count("events_drawn", sum(1 for item in displayList if type(item) is BoxItem))
+
+    fingerprint = getDisplayListFingerprint(displayList)[:32]
+    if frameStore.getETag("default") == fingerprint:
+        logging.info("Calendar has not changed since the last refresh, keeping the frame that is served")
+        metrics.count("refresh_skipped")
+        return piEvents
+
+    frameStore.setFrame("default", renderPanelBuffer(renderer, displayList), fingerprint)
+    return piEvents
+
+# Renders the calendar whenever it can change, like runDaemon, and serves it over HTTP. The buffers made by
+# panels.py in resources/panels are served too.
+def runServer(port):
+    from fileepd import FileEPD
+    from frameserver import FrameStore, startFrameServer
+
+    frameStore = FrameStore(os.path.join(resdir, "panels"))
+    startFrameServer(frameStore, host=frameServerHost, port=port)
+    renderer = FileEPD(os.path.join(resdir, fileDisplayDir), latencyScale=0)
+
+    while True:
+        piEvents = []
+        metrics.reset()
+        try:
+            piEvents = serveRefresh(renderer, frameStore)
+        except IOError as e:
+            logging.info(e)
+        except Exception:
+            logging.exception("Render failed, keeping the last frame that is served")
+        finally:
+            writeRunMetrics()
+
+        nowEpoch = time.time()
+        wakeTime = getNextChangeTime(piEvents, nowEpoch)
+        logging.info(f"Next render at {datetime.fromtimestamp(wakeTime).strftime('%m/%d %H:%M:%S')}")
+        time.sleep(max(1, wakeTime - nowEpoch + 1))
+
+# Client mode: downloads the packed buffer from a frame server and shows it when it changed. Nothing is fetched from
+# Google or drawn here.
+def clientRefresh(epd, frameUrl):
+    from frameserver import fetchFrame
+
+    metrics.reset()
+    panelInit = None
+    try:
+        lastFrame = readLastFrame()
+        etag = lastFrame.get("fingerprint")
+        if not skipUnchangedFrames or isForcedRefreshDue(lastFrame):
+            etag = None
+            # The frame is shown whatever it is, so the panel can wake up during the download
+            if pipelinePanelInit:
+                panelInit = startPanelInit(epd)
+
+        with metrics.stage("download frame"):
+            newETag, panelBuffer = fetchFrame(frameUrl, etag, fetchTimeoutSeconds)
+
+        if panelBuffer is None:
+            logging.info("Frame has not changed since the last refresh, leaving the screen as it is")
+            metrics.count("refresh_skipped")
+            return
+
+        metrics.count("bytes_received", len(panelBuffer))
+        showPanelBuffer(epd, panelBuffer, panelInit)
+        panelInit = None
+        saveLastFrame(newETag)
+    finally:
+        if panelInit is not None:
+            stopPanel(epd, panelInit)
+        writeRunMetrics()
+
+# Logs the timings of the refresh as one JSON line and writes them to resources/metrics.json and, when
+# prometheusTextFile is set, to a file for the Prometheus node exporter textfile collector. Then writes the state
+# files that are due. The bytes written to the card count in the run they were written in, so the metrics files
+# themselves are counted in the next run.
+def writeRunMetrics():
+    store = getStateStore()
+    for name, value in store.takeCounters().items():
+        metrics.count(name, value)
+
+    peakTracedKb = metrics.getPeakTracedKb()
+    if memoryBudgetKb and peakTracedKb is not None and peakTracedKb > memoryBudgetKb:
+        logging.warning(f"Peak memory of {peakTracedKb} KB is over the budget of {memoryBudgetKb} KB")
+        metrics.count("memory_budget_exceeded")
+
+    record = metrics.getRecord()
+    logging.info(f"Run metrics: {json.dumps(record)}")
+
+    try:
+        if metricsFile:
+            store.write(metricsFile, metrics.getJson(record), volatile=True)
+        if prometheusTextFile:
+            store.write(prometheusTextFile, metrics.getPrometheusText(record))
+        store.flush()
+    except OSError as e:
+        logging.warning(f"Could not write the run metrics: {e}")
+
+# Returns the epoch time of the next moment the calendar can look different: local midnight (the "Today" and
+# "Tomorrow" labels move and the day headers shift), the end of a displayed event (it drops off the calendar),
+# or the next poll for changes made in Google calendar, whichever comes first.
+def getNextChangeTime(piEvents, nowEpoch):
+    return min(getNextContentChange(piEvents, nowEpoch), nowEpoch + pollIntervalMinutes * 60)
+
+# Returns the epoch time of the next moment the calendar looks different without any change in Google calendar:
+# local midnight or the end of a displayed event
+def getNextContentChange(piEvents, nowEpoch):
+    nextMidnight = datetime.combine(date.fromtimestamp(nowEpoch) + timedelta(days=1), datetime.min.time())
+    changeTimes = [nextMidnight.timestamp()]
+
+    for event in piEvents:
+        if event.eventEndTime is not None:
+            eventEnd = event.eventEndTime.timestamp()
+            if eventEnd > nowEpoch:
+                changeTimes.append(eventEnd)
+
+    return min(changeTimes)
+
+# Returns what the frames drawn ahead of time depend on: the events that have not ended at nowEpoch, in sort order
+def getUpcomingEventKeys(piEvents, nowEpoch):
+    eventKeys = []
+    for event in piEvents:
+        eventEnd = event.eventEndTime.timestamp() if event.eventEndTime is not None else None
+        if eventEnd is None or eventEnd > nowEpoch:
+            eventKeys.append((event.calendarName, event.eventSummary, event.sortKey, eventEnd))
+    return eventKeys
+
+# After a refresh, makes sure precomputed holds the frames of the coming changes. The frames drawn after an earlier
+# fetch are kept when the new fetch brought the same upcoming events, so an unchanged calendar is not drawn again
+# every poll. piEvents and lookaheadEvents come from layoutCalendars.
+def updatePrecomputedFrames(epd, precomputed, piEvents, lookaheadEvents):
+    nowEpoch = time.time()
+    sourceEvents = piEvents + lookaheadEvents
+    sourceComplete = len(lookaheadEvents) <= precomputeLookahead
+
+    if len(precomputed) > 0:
+        oldKeys = getUpcomingEventKeys(precomputed.sourceEvents, nowEpoch)
+        newKeys = getUpcomingEventKeys(sourceEvents, nowEpoch)
+        # The old frames only read as far as the old events went, so more events after those change nothing, unless
+        # the old events were all of them
+        if newKeys[:len(oldKeys)] == oldKeys and (len(newKeys) == len(oldKeys) or not precomputed.sourceComplete):
+            logging.info(f"Calendar has not changed, keeping {len(precomputed)} frames drawn ahead of time")
+            metrics.count("precomputed_frames_kept", len(precomputed))
+            return
+
+    precomputed.clear()
+    precomputed.sourceEvents = sourceEvents
+    precomputed.sourceComplete = sourceComplete
+    precomputeFrames(epd, precomputed, piEvents, nowEpoch)
+
+# Lays out, draws and packs the frame of every change in the next precomputeHours hours, one after the other: each
+# frame starts from the events shown in the one before. Stops early when a frame needs events that were not read.
+def precomputeFrames(epd, precomputed, piEvents, nowEpoch):
+    untilEpoch = nowEpoch + precomputeHours * 3600
+    shownEvents = piEvents
+
+    while len(precomputed) < maxPrecomputedFrames:
+        changeEpoch = getNextContentChange(shownEvents, nowEpoch)
+        if changeEpoch > untilEpoch:
+            break
+
+        # Laid out for a second after the change, like runDaemon refreshes, so the events that just ended are gone
+        frameEpoch = changeEpoch + 1
+        upcomingEvents = [event for event in precomputed.sourceEvents
+                          if event.eventEndTime is None or event.eventEndTime.timestamp() > frameEpoch]
+
+        usedEvents = []
+        ranOut = []
+        def readUpcomingEvents():
+            yield from recordEvents(upcomingEvents, usedEvents)
+            ranOut.append(True)
+
+        displayList = layoutEvents(readUpcomingEvents(), originX, originY, datetime.fromtimestamp(frameEpoch))
+        if ranOut and not precomputed.sourceComplete:
+            logging.debug(f"Not enough events to draw the frame of {datetime.fromtimestamp(changeEpoch)} ahead")
+            break
+
+        panelBuffer = renderPanelBuffer(epd, displayList, datetime.fromtimestamp(frameEpoch))
+        precomputed.add(changeEpoch, getDisplayListFingerprint(displayList), panelBuffer, usedEvents)
+        metrics.count("precomputed_frames")
+
+        shownEvents = usedEvents
+        nowEpoch = frameEpoch
+
+    if len(precomputed) > 0:
+        logging.info(f"Drew {len(precomputed)} frames ahead of time, {precomputed.getStoredBytes()} bytes")
+
+# Sends a frame drawn ahead of time to the panel. frame is what PrecomputedFrames.take returned. Returns the events
+# shown in the frame.
+def showPrecomputedFrame(epd, frame):
+    fingerprint, panelBuffer, piEvents = frame
+
+    metrics.reset()
+    try:
+        if isRefreshNeeded(fingerprint):
+            showPanelBuffer(epd, panelBuffer)
+            saveLastFrame(fingerprint)
+            metrics.count("precomputed_frame_shown")
+        else:
+            logging.info("Calendar has not changed since the last refresh, leaving the screen as it is")
+            metrics.count("refresh_skipped")
+    finally:
+        writeRunMetrics()
+
+    return piEvents
+
+# Keeps running, refreshing the display only when its content can change. Fonts, credentials, the calendar service
+# and the EPD object stay loaded between refreshes. Changes that come before the next poll are shown from the frames
+# drawn ahead of time (see usePrecomputedFrames).
+def runDaemon(epd):
+    precomputed = PrecomputedFrames() if usePrecomputedFrames else None
+    nextPollEpoch = 0
+
+    while True:
+        piEvents = []
+        frame = None
+        if precomputed is not None and time.time() < nextPollEpoch:
+            frame = precomputed.take(time.time())
+
+        try:
+            if frame is not None:
+                piEvents = showPrecomputedFrame(epd, frame)
+            else:
+                nextPollEpoch = time.time() + pollIntervalMinutes * 60
+                piEvents = refreshDisplay(epd, precomputed)
+        except IOError as e:
+            logging.info(e)
+        except Exception:
+            # Whatever went wrong in this refresh, the last frame stays on screen and the next one is tried as usual
+            logging.exception("Refresh failed, keeping the last frame on the screen")
+
+        nowEpoch = time.time()
+        changeTimes = [getNextContentChange(piEvents, nowEpoch), max(nextPollEpoch, nowEpoch)]
+        if precomputed is not None:
+            changeTimes.extend(precomputed.getChangeTimes()[:1])
+        wakeTime = min(changeTimes)
+        logging.info(f"Next refresh at {datetime.fromtimestamp(wakeTime).strftime('%m/%d %H:%M:%S')}")
+
+        # Wake up a second after the change, so the event that just ended is already in the past
+        time.sleep(max(1, wakeTime - nowEpoch + 1))
+
+def main():
+    parser = argparse.ArgumentParser(description="Draws upcoming Google calendar events on a Waveshare 7.3 inch e-ink display")
+    parser.add_argument("--daemon", action="store_true",
+                        help="keep running and refresh the display whenever its content can change")
+    parser.add_argument("--backend", choices=["waveshare", "file"], default=displayBackend,
+                        help="draw on the e-ink panel, or write the frames to resources/%s" % fileDisplayDir)
+    parser.add_argument("--serve", nargs="?", type=int, const=frameServerPort, metavar="PORT",
+                        help="render the calendar and serve the panel buffer over HTTP on PORT (%d)" % frameServerPort)
+    parser.add_argument("--client", metavar="URL",
+                        help="only download the panel buffer from a frame server, e.g. http://server:%d/frames/default"
+                             % frameServerPort)
+    parser.add_argument("--profile", nargs="?", const=os.path.join(resdir, "profile.out"), metavar="FILE",
+                        help="profile the whole run with cProfile and save the stats to FILE (resources/profile.out)")
+    args = parser.parse_args()
+
+    # Stopping the service sends SIGTERM. Exit normally, so the state still in memory is written (see getStateStore)
+    signal.signal(signal.SIGTERM, lambda signalNumber, frame: sys.exit(0))
+
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        runMain(args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            logging.info(f"Profile saved to {args.profile}. View it with: python -m pstats {args.profile}")
+
+def runMain(args):
+    metrics.traceMemory = traceStageMemory
+    metrics.tracePeakMemory = memoryBudgetKb is not None
+
+    if args.serve is not None:
+        loadConfigFiles()
+        runServer(args.serve)
+        return
+
+    if args.client is None:
+        loadConfigFiles()
+
+    try:
+        epd = createDisplay(args.backend)
+
+        if args.client is not None:
+            while True:
+                try:
+                    clientRefresh(epd, args.client)
+                except IOError as e:
+                    logging.warning(f"Could not download the frame from {args.client}: {e}")
+                except Exception:
+                    if not args.daemon:
+                        raise
+                    logging.exception("Refresh failed, keeping the last frame on the screen")
+
+                if not args.daemon:
+                    break
+                time.sleep(pollIntervalMinutes * 60)
+        elif args.daemon:
+            runDaemon(epd)
+        else:
+            refreshDisplay(epd)
 
     except IOError as e:
         logging.info(e)
 
     except KeyboardInterrupt:
         logging.info("ctrl + c:")
-        epd7in3f.epdconfig.module_exit(cleanup=True)
+        if epd7in3f is not None:
+            epd7in3f.epdconfig.module_exit(cleanup=True)
         exit()
 
 if __name__ == "__main__":
@@ -0,0 +1,94 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# Checks the memory budget of a refresh against the fake Calendar API, without a Google account or a panel. Fails
+# when a refresh of the generated calendars allocates more than its budget at its peak, as traced by tracemalloc,
+# with lowMemoryMode off and on.
+#
+# It also runs the refreshes one after the other, like the daemon does, with one refresh that allocates a lot more
+# than the budget: only that refresh may go over, the next one has to be back under it.
+import argparse
+import logging
+import os
+import tempfile
+
+import main
+import loadtest
+from fakecalendarapi import FakeCalendarApi, generateCalendarData
+
+# Peak KB one refresh of the generated calendars may allocate, for lowMemoryMode off and on. The refresh on a
+# regular computer stays well under these, so only a real regression trips them
+refreshBudgetKb = {False: 2048, True: 1024}
+
+# How much the refresh in the middle allocates on top of the others, in KB
+spikeKb = 8192
+
+
+# Runs one refresh and returns the peak memory it allocated in KB
+def measureRefresh(lowMemory):
+    main.lowMemoryMode = lowMemory
+    return loadtest.runRefresh()["peakTracedKb"]
+
+# Runs three refreshes like the daemon and returns their peaks in KB. The second one holds on to spikeKb KB while
+# the events are loaded
+def measureDaemonRefreshes():
+    loadCalendarEvents = main.loadCalendarEvents
+
+    def loadWithSpike():
+        spike = bytearray(spikeKb * 1024)
+        events = loadCalendarEvents()
+        del spike
+        return events
+
+    peaks = [measureRefresh(False)]
+    main.loadCalendarEvents = loadWithSpike
+    try:
+        peaks.append(measureRefresh(False))
+    finally:
+        main.loadCalendarEvents = loadCalendarEvents
+    peaks.append(measureRefresh(False))
+    return peaks
+
+def runCheck():
+    parser = argparse.ArgumentParser(description="Checks that a refresh stays under its memory budget")
+    parser.add_argument("--calendars", type=int, default=10, help="number of generated calendars")
+    parser.add_argument("--events", type=int, default=2000, help="number of generated events")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.ERROR)
+
+    server = FakeCalendarApi(generateCalendarData(args.calendars, args.events)).start()
+    main.loadConfigFiles()
+    main.makeFakeEvents = False
+    # One calendar at a time, so the peak does not depend on how the fetch threads overlap
+    main.fetchConcurrency = 1
+    loadtest.useCalendarApi(server.baseUrl)
+    main.metrics.tracePeakMemory = True
+
+    failures = []
+    with tempfile.TemporaryDirectory() as storeDir:
+        main.eventStoreFile = os.path.join(storeDir, "events.db")
+        # The first refresh downloads the calendars into the event store, the ones after it read them from there
+        measureRefresh(False)
+
+        for lowMemory, budgetKb in refreshBudgetKb.items():
+            peakKb = measureRefresh(lowMemory)
+            print(f"lowMemoryMode {str(lowMemory):5}  peak {peakKb:8.1f} KB  budget {budgetKb} KB")
+            if peakKb > budgetKb:
+                failures.append(f"a refresh with lowMemoryMode {lowMemory} allocated {peakKb:.1f} KB")
+
+        budgetKb = refreshBudgetKb[False]
+        peaks = measureDaemonRefreshes()
+        print(f"daemon refreshes, the second with {spikeKb} KB more: " + ", ".join(f"{peakKb:.1f} KB" for peakKb in peaks))
+        if peaks[1] <= budgetKb:
+            failures.append(f"the refresh that allocated {spikeKb} KB more was not over the budget")
+        if peaks[2] > budgetKb:
+            failures.append("the refresh after the large one was still over the budget")
+
+    if failures:
+        print("\nMemory budget check failed:")
+        for failure in failures:
+            print(f"  {failure}")
+        exit(1)
+
+if __name__ == "__main__":
+    runCheck()
@@ -0,0 +1,178 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# Renders the calendar for several frames at once. The calendars are fetched one time, with one Google account, and
+# then every panel profile is laid out, drawn and packed in its own process. Each profile is a folder in
+# resources/panels with its own color-map.txt, excludes.txt and panel.txt; a profile that leaves out color-map.txt or
+# excludes.txt uses the one in resources. The packed panel buffer of each profile is written to display.bin in its
+# folder, ready to be sent to the panel.
+#
+# panel.txt holds the layout of the profile, one setting per line, for example:
+#     orientation=landscape
+#     originX=20
+#     originY=20
+#     maxX=759
+#     maxY=399
+import argparse
+import logging
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+import main
+from PIL import ImageDraw
+from displaylist import drawDisplayList, getDisplayListFingerprint
+from framebuffer import newPanelImage, packPanelBuffer
+
+panelsDir = os.path.join(main.resdir, "panels")
+panelBufferFile = "display.bin"
+fingerprintFile = "fingerprint.txt"
+
+# Panel resolution, the same for every profile
+panelWidth = 800
+panelHeight = 480
+
+# Layout settings a profile can change in panel.txt. Everything else is taken from main.py
+layoutSettings = ["originX", "originY", "maxX", "maxY"]
+defaultLayout = {name: getattr(main, name) for name in layoutSettings}
+
+
+# Returns the folders in resources/panels that hold a panel.txt, sorted by name
+def findProfiles(panelsDir):
+    profiles = []
+    if os.path.isdir(panelsDir):
+        for name in sorted(os.listdir(panelsDir)):
+            if os.path.exists(os.path.join(panelsDir, name, "panel.txt")):
+                profiles.append(os.path.join(panelsDir, name))
+    return profiles
+
+# Reads panel.txt of a profile. Returns the orientation and the layout settings
+def readPanelSettings(profileDir):
+    orientation = "portrait"
+    layout = dict(defaultLayout)
+
+    with open(os.path.join(profileDir, "panel.txt"), "r") as settingsFile:
+        for line in settingsFile:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+
+            name, value = [part.strip() for part in line.split("=", 1)]
+            if name == "orientation":
+                if value not in ("portrait", "landscape"):
+                    raise ValueError(f"Unknown orientation {value} in {profileDir}")
+                orientation = value
+            elif name in layoutSettings:
+                layout[name] = int(value)
+            else:
+                logging.warning(f"Unknown setting {name} in {profileDir}/panel.txt")
+
+    return orientation, layout
+
+# Returns the calendars that every profile excludes. Only those can be left out of the fetch
+def getSharedExcludes(profiles):
+    sharedExcludes = None
+    for profileDir in profiles:
+        main.loadConfigFiles(profileDir)
+        if sharedExcludes is None:
+            sharedExcludes = set(main.EXCLUDE_LIST)
+        else:
+            sharedExcludes &= set(main.EXCLUDE_LIST)
+    return sharedExcludes or set()
+
+# Lays out, draws and packs one profile. Runs in a worker process, which may render several profiles one after the
+# other, so every setting of the previous profile is replaced. A profile whose layout did not change keeps its
+# display.bin, so a frame server (see frameserver.py) keeps serving it with the same ETag. Returns the name, the frame
+# fingerprint, whether the frame was drawn, the time and the counters of the files it wrote, which the worker process
+# cannot add to the run metrics itself.
+def renderProfile(profileDir, eventLists):
+    start = time.perf_counter()
+
+    main.loadConfigFiles(profileDir)
+    orientation, layout = readPanelSettings(profileDir)
+    for name, value in layout.items():
+        setattr(main, name, value)
+
+    excludes = set(main.EXCLUDE_LIST)
+    eventStreams = [[event for event in events if event.calendarName not in excludes] for events in eventLists]
+    displayList, piEvents = main.layoutCalendars(eventStreams, main.originX, main.originY)
+
+    # The same layout drawn in another orientation is another frame
+    if orientation == "portrait":
+        imageSize = (panelHeight, panelWidth)
+    else:
+        imageSize = (panelWidth, panelHeight)
+    fingerprint = getDisplayListFingerprint((orientation, imageSize, displayList))
+
+    stateStore = main.getStateStore()
+    bufferPath = os.path.join(profileDir, panelBufferFile)
+    fingerprintPath = os.path.join(profileDir, fingerprintFile)
+    if os.path.exists(bufferPath) and readFingerprint(fingerprintPath) == fingerprint:
+        return os.path.basename(profileDir), fingerprint, False, time.perf_counter() - start, stateStore.takeCounters()
+
+    image = newPanelImage(imageSize)
+    drawDisplayList(ImageDraw.Draw(image), displayList + main.layoutFooter(main.originX), main.drawText, main.getInk,
+                    main.getFont)
+    panelBuffer = packPanelBuffer(image, panelWidth, panelHeight)
+
+    stateStore.write(bufferPath, panelBuffer)
+    stateStore.write(fingerprintPath, fingerprint + "\n")
+
+    return os.path.basename(profileDir), fingerprint, True, time.perf_counter() - start, stateStore.takeCounters()
+
+def readFingerprint(fingerprintPath):
+    try:
+        with open(fingerprintPath, "r") as fingerprintIn:
+            return fingerprintIn.read().strip()
+    except FileNotFoundError:
+        return None
+
+def renderPanels():
+    parser = argparse.ArgumentParser(description="Fetches the calendars once and renders every panel profile in "
+                                                 "resources/panels")
+    parser.add_argument("--panels", default=panelsDir, help="folder with one subfolder per panel profile")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of render processes")
+    args = parser.parse_args()
+
+    profiles = findProfiles(args.panels)
+    if not profiles:
+        print(f"No panel profiles found in {args.panels}")
+        exit(1)
+
+    main.metrics.reset()
+    try:
+        # Only calendars that no profile shows are left out of the fetch
+        sharedExcludes = getSharedExcludes(profiles)
+        main.loadConfigFiles()
+        main.EXCLUDE_LIST[:] = sorted(sharedExcludes)
+
+        # The worker processes get plain lists of events. Later pages of a calendar are downloaded here, since every
+        # profile may need a different number of events
+        eventLists = [list(events) for events in main.loadCalendarEvents()]
+        main.metrics.count("events_loaded", sum(len(events) for events in eventLists))
+
+        with main.metrics.stage("render panels"):
+            with ProcessPoolExecutor(max_workers=max(1, min(args.workers, len(profiles)))) as executor:
+                futures = [executor.submit(renderProfile, profileDir, eventLists) for profileDir in profiles]
+
+                for profileDir, future in zip(profiles, futures):
+                    try:
+                        name, fingerprint, drawn, seconds, stateCounters = future.result()
+                    except (OSError, ValueError) as e:
+                        logging.warning(f"Could not render the panel profile {profileDir}: {e}")
+                        continue
+
+                    for counterName, value in stateCounters.items():
+                        main.metrics.count(counterName, value)
+
+                    if drawn:
+                        main.metrics.count("panels_rendered")
+                        logging.info(f"Rendered {name} in {seconds:.2f}s, fingerprint {fingerprint[:12]}")
+                    else:
+                        main.metrics.count("panels_unchanged")
+                        logging.info(f"{name} has not changed, keeping its frame")
+    finally:
+        main.writeRunMetrics()
+
+if __name__ == "__main__":
+    renderPanels()
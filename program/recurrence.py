@@ -0,0 +1,90 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+import functools
+import json
+import logging
+
+from datetime import datetime, timezone
+
+from eventstore import getEventEpoch
+
+# python-dateutil is optional. Without it, main.py downloads every occurrence of a recurring event as before
+try:
+    from dateutil import rrule
+except ImportError:
+    rrule = None
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:
+    ZoneInfo = None
+
+
+# Works out the occurrences of recurring events locally, from the RRULE, EXDATE and RDATE lines of the recurring
+# event, so the Calendar API does not have to send every occurrence separately (singleEvents=False). Occurrences that
+# were moved or cancelled in Google calendar come from the API as separate events; their original start times are
+# passed in as skippedStarts so the rule does not make them a second time.
+
+def isAvailable():
+    return rrule is not None
+
+# Returns the occurrences of one recurring event that overlap the window from windowStartEpoch to windowEndEpoch, as
+# event dicts shaped like the Calendar API's, in start time order. masterJson is the stored recurring event and
+# skippedStarts a frozenset of the start epochs to leave out. The result is memoized: the window is aligned to days,
+# so every refresh of the same day reuses it as long as the event does not change. Do not modify what it returns.
+@functools.lru_cache(maxsize=1024)
+def expandRecurringEvent(masterJson, windowStartEpoch, windowEndEpoch, skippedStarts=frozenset()):
+    master = json.loads(masterJson)
+    start = master["start"]
+    end = master["end"]
+
+    if "dateTime" in start:
+        allDay = False
+        eventStart = datetime.fromisoformat(start["dateTime"])
+        # Expand in the time zone of the event, so a 9:00 meeting stays at 9:00 after a daylight saving change
+        if start.get("timeZone") and ZoneInfo is not None:
+            eventStart = eventStart.astimezone(ZoneInfo(start["timeZone"]))
+        duration = datetime.fromisoformat(end["dateTime"]) - eventStart
+        windowStart = datetime.fromtimestamp(windowStartEpoch, tz=timezone.utc)
+        windowEnd = datetime.fromtimestamp(windowEndEpoch, tz=timezone.utc)
+    else:
+        allDay = True
+        eventStart = datetime.fromisoformat(start["date"])
+        duration = datetime.fromisoformat(end["date"]) - eventStart
+        windowStart = datetime.fromtimestamp(windowStartEpoch)
+        windowEnd = datetime.fromtimestamp(windowEndEpoch)
+
+    try:
+        ruleSet = rrule.rrulestr("\n".join(master.get("recurrence", [])), dtstart=eventStart, forceset=True,
+                                 unfold=True)
+        # Occurrences that started before the window can still run into it
+        occurrences = ruleSet.between(windowStart - duration, windowEnd, inc=False)
+    except (ValueError, TypeError) as error:
+        logging.warning(f"Could not expand the recurring event {master.get('summary')}: {error}")
+        return ()
+
+    instances = []
+    for occurrence in occurrences:
+        occurrenceEnd = occurrence + duration
+        if allDay:
+            instanceStart = {"date": occurrence.date().isoformat()}
+            instanceEnd = {"date": occurrenceEnd.date().isoformat()}
+        else:
+            instanceStart = {"dateTime": occurrence.isoformat()}
+            instanceEnd = {"dateTime": occurrenceEnd.isoformat()}
+
+        if getEventEpoch(instanceStart) in skippedStarts:
+            continue
+
+        instances.append({"summary": master.get("summary", ""), "start": instanceStart, "end": instanceEnd})
+
+    return tuple(instances)
+
+# Returns the occurrences of all recurring events of a calendar in the window. recurringEvents is a list of
+# (eventId, eventJson) and skippedStarts maps the id of a recurring event to the start epochs to leave out.
+def expandRecurringEvents(recurringEvents, skippedStarts, windowStartEpoch, windowEndEpoch):
+    instances = []
+    for eventId, masterJson in recurringEvents:
+        instances.extend(expandRecurringEvent(masterJson, windowStartEpoch, windowEndEpoch,
+                                              skippedStarts.get(eventId, frozenset())))
+    return instances
@@ -0,0 +1,208 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+import json
+import os
+import resource
+import threading
+import time
+import tracemalloc
+
+from contextlib import contextmanager
+
+
+# Stage timers and counters for one refresh. Every phase of a refresh runs inside a stage, so when a frame is slow
+# it is easy to see where the time went. Fetch threads record their time per calendar. At the end of the refresh,
+# main.py writes the numbers as a JSON record and as a Prometheus textfile collector file.
+#
+# With traceMemory, every stage also records the peak of the memory traced by tracemalloc while it ran, the peak RSS
+# of the process when it ended (the stage where it jumps is the one that needed the memory) and the source lines that
+# allocated the most memory that was still held at its end. Tracing makes the run several times slower.
+#
+# With tracePeakMemory, only the peak of the memory traced by tracemalloc during the run is recorded, as peakTracedKb.
+# The peak is reset at the start of every run, so in daemon mode one large refresh does not count against the ones
+# after it, the way the peak RSS of the process does.
+class RunMetrics():
+    # Number of allocating source lines kept for every stage
+    topAllocatorCount = 5
+
+    def __init__(self, traceMemory=False, tracePeakMemory=False):
+        self.lock = threading.Lock()
+        self.traceMemory = traceMemory
+        self.tracePeakMemory = tracePeakMemory
+        self.reset()
+
+    # Starts a new run. The daemon calls this before every refresh
+    def reset(self):
+        with self.lock:
+            self.startTime = time.time()
+            self.startCounter = time.perf_counter()
+            self.stageSeconds = {}
+            self.calendarSeconds = {}
+            self.counters = {}
+            self.stageMemory = {}
+            self.openMemoryStages = []
+            self.peakBytes = 0
+
+        if self.traceMemory or self.tracePeakMemory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+
+    # Times the code in the with block. A stage that runs more than once adds up its time
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        memoryStage = self.startMemoryStage() if self.traceMemory else None
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.stageSeconds[name] = self.stageSeconds.get(name, 0) + elapsed
+            if memoryStage is not None:
+                self.endMemoryStage(name, memoryStage)
+
+    # Stages can be nested and can run on other threads at the same time, so the tracemalloc peak is handed to every
+    # open stage before it is reset for the next one. The memory the open stages use to remember the allocations at
+    # their start is not counted
+    def updateMemoryPeaks(self):
+        peakBytes = self.getTracedPeakBytes()
+        for memoryStage in self.openMemoryStages:
+            memoryStage["peakBytes"] = max(memoryStage["peakBytes"], peakBytes)
+        self.peakBytes = max(self.peakBytes, peakBytes)
+        tracemalloc.reset_peak()
+
+    def getTracedPeakBytes(self):
+        peakBytes = tracemalloc.get_traced_memory()[1]
+        return peakBytes - sum(memoryStage["overheadBytes"] for memoryStage in self.openMemoryStages)
+
+    # Peak of the memory traced since the run started, in KB. None when nothing is traced
+    def getPeakTracedKb(self):
+        if not tracemalloc.is_tracing() or not (self.traceMemory or self.tracePeakMemory):
+            return None
+        with self.lock:
+            return round(max(self.peakBytes, self.getTracedPeakBytes()) / 1024, 1)
+
+    def startMemoryStage(self):
+        with self.lock:
+            self.updateMemoryPeaks()
+            startBytes = tracemalloc.get_traced_memory()[0]
+            memoryStage = {"peakBytes": 0, "overheadBytes": 0, "lineSizes": getTracedLineSizes()}
+            memoryStage["overheadBytes"] = tracemalloc.get_traced_memory()[0] - startBytes
+            self.openMemoryStages.append(memoryStage)
+            tracemalloc.reset_peak()
+            return memoryStage
+
+    def endMemoryStage(self, name, memoryStage):
+        with self.lock:
+            self.updateMemoryPeaks()
+            self.openMemoryStages = [openStage for openStage in self.openMemoryStages if openStage is not memoryStage]
+
+            startSizes = memoryStage["lineSizes"]
+            growth = sorted(((size - startSizes.get(line, 0), line) for line, size in getTracedLineSizes().items()),
+                            reverse=True)
+            topAllocators = [f"{os.path.basename(fileName)}:{lineNumber} {sizeDiff / 1024:+.1f} KB"
+                             for sizeDiff, (fileName, lineNumber) in growth[:self.topAllocatorCount] if sizeDiff > 0]
+
+            # A stage that runs more than once keeps its highest peak and the allocators of its last run
+            stageMemory = self.stageMemory.setdefault(name, {"peakKb": 0})
+            stageMemory["peakKb"] = max(stageMemory["peakKb"], round(memoryStage["peakBytes"] / 1024, 1))
+            stageMemory["maxRssKb"] = getMaxRssKb()
+            stageMemory["topAllocators"] = topAllocators
+
+            del growth
+            tracemalloc.reset_peak()
+
+    # Times fetching one calendar. Safe to use from the fetch threads
+    @contextmanager
+    def calendarStage(self, calendarName):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.calendarSeconds[calendarName] = self.calendarSeconds.get(calendarName, 0) + elapsed
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def getRecord(self):
+        peakTracedKb = self.getPeakTracedKb()
+        with self.lock:
+            return {
+                "timestamp": int(self.startTime),
+                "totalSeconds": round(time.perf_counter() - self.startCounter, 4),
+                "stageSeconds": {name: round(seconds, 4) for name, seconds in self.stageSeconds.items()},
+                "calendarSeconds": {name: round(seconds, 4) for name, seconds in self.calendarSeconds.items()},
+                "counters": dict(self.counters),
+                "maxRssKb": getMaxRssKb(),
+                "peakTracedKb": peakTracedKb,
+                "stageMemory": {name: dict(memory) for name, memory in self.stageMemory.items()},
+            }
+
+    def getJson(self, record=None):
+        if record is None:
+            record = self.getRecord()
+        return json.dumps(record, indent=2) + "\n"
+
+    # Returns the record in the Prometheus text format. The node exporter textfile collector reads every *.prom file
+    # in its directory, so the file has to be written under a temporary name first and then renamed.
+    def getPrometheusText(self, record=None):
+        if record is None:
+            record = self.getRecord()
+
+        lines = [
+            "# HELP picalendar_last_run_timestamp_seconds When the last refresh started.",
+            "# TYPE picalendar_last_run_timestamp_seconds gauge",
+            f"picalendar_last_run_timestamp_seconds {record['timestamp']}",
+            "# HELP picalendar_run_seconds Wall time of the last refresh.",
+            "# TYPE picalendar_run_seconds gauge",
+            f"picalendar_run_seconds {record['totalSeconds']}",
+            "# HELP picalendar_stage_seconds Wall time of each stage of the last refresh.",
+            "# TYPE picalendar_stage_seconds gauge",
+        ]
+        for name, seconds in record["stageSeconds"].items():
+            lines.append(f'picalendar_stage_seconds{{stage="{escapeLabel(name)}"}} {seconds}')
+
+        lines.append("# HELP picalendar_max_rss_bytes Peak resident memory of the process.")
+        lines.append("# TYPE picalendar_max_rss_bytes gauge")
+        lines.append(f"picalendar_max_rss_bytes {record['maxRssKb'] * 1024}")
+        if record["peakTracedKb"] is not None:
+            lines.append("# HELP picalendar_peak_traced_bytes Peak memory traced by tracemalloc in the last refresh.")
+            lines.append("# TYPE picalendar_peak_traced_bytes gauge")
+            lines.append(f"picalendar_peak_traced_bytes {int(record['peakTracedKb'] * 1024)}")
+        if record["stageMemory"]:
+            lines.append("# HELP picalendar_stage_peak_traced_bytes Peak memory traced by tracemalloc in each stage.")
+            lines.append("# TYPE picalendar_stage_peak_traced_bytes gauge")
+            for name, memory in record["stageMemory"].items():
+                lines.append(f'picalendar_stage_peak_traced_bytes{{stage="{escapeLabel(name)}"}} '
+                             f'{int(memory["peakKb"] * 1024)}')
+
+        lines.append("# HELP picalendar_calendar_fetch_seconds Time spent fetching each calendar in the last refresh.")
+        lines.append("# TYPE picalendar_calendar_fetch_seconds gauge")
+        for name, seconds in record["calendarSeconds"].items():
+            lines.append(f'picalendar_calendar_fetch_seconds{{calendar="{escapeLabel(name)}"}} {seconds}')
+
+        for name, value in record["counters"].items():
+            lines.append(f"# TYPE picalendar_{name} gauge")
+            lines.append(f"picalendar_{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+def escapeLabel(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+# Peak resident memory of the process so far, in KB. ru_maxrss is in KB on Linux
+def getMaxRssKb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+# Returns the memory traced by tracemalloc, by allocating source line, as {(file name, line number): bytes}.
+# Allocations of tracemalloc and of this file are left out
+def getTracedLineSizes():
+    snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                                          tracemalloc.Filter(False, __file__)])
+    return {(stat.traceback[0].filename, stat.traceback[0].lineno): stat.size
+            for stat in snapshot.statistics("lineno")}
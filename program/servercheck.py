@@ -0,0 +1,67 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# Checks the frame server of frameserver.py on localhost: a frame is downloaded with its ETag, asked for again with
+# that ETag in If-None-Match (304, nothing downloaded), changed, and downloaded again. The same is done for the
+# buffer of a panel profile on disk. Exits with an error when an answer is not the expected one.
+import logging
+import os
+import tempfile
+import urllib.error
+
+from frameserver import FrameStore, fetchFrame, startFrameServer
+
+failures = []
+
+
+def check(description, isExpected):
+    print(f"{description:48} {'ok' if isExpected else 'FAILED'}")
+    if not isExpected:
+        failures.append(description)
+
+# Downloads a frame and returns the HTTP status, with the ETag and buffer of fetchFrame
+def getFrame(url, etag=None):
+    try:
+        newETag, buffer = fetchFrame(url, etag, timeoutSeconds=5)
+    except urllib.error.HTTPError as error:
+        return error.code, None, None
+    return (304 if buffer is None else 200), newETag, buffer
+
+def runCheck():
+    logging.getLogger().setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as panelsDir:
+        frameStore = FrameStore(panelsDir)
+        frameStore.setFrame("default", b"\x11" * 16, "first")
+        server = startFrameServer(frameStore, port=0)
+        baseUrl = f"http://127.0.0.1:{server.server_port}/frames"
+        try:
+            check("listens on localhost only", server.server_address[0] == "127.0.0.1")
+
+            status, etag, buffer = getFrame(f"{baseUrl}/default")
+            check("GET a frame", (status, etag, buffer) == (200, "first", b"\x11" * 16))
+            status, etag, buffer = getFrame(f"{baseUrl}/default", etag)
+            check("GET with the ETag of that frame gives 304", (status, etag, buffer) == (304, "first", None))
+
+            frameStore.setFrame("default", b"\x22" * 16, "second")
+            status, etag, buffer = getFrame(f"{baseUrl}/default", "first")
+            check("GET with the ETag of an older frame", (status, etag, buffer) == (200, "second", b"\x22" * 16))
+
+            os.makedirs(os.path.join(panelsDir, "kitchen"))
+            with open(os.path.join(panelsDir, "kitchen", "display.bin"), "wb") as bufferFile:
+                bufferFile.write(b"\x33" * 16)
+            status, etag, buffer = getFrame(f"{baseUrl}/kitchen")
+            check("GET the frame of a panel profile", (status, buffer) == (200, b"\x33" * 16) and bool(etag))
+            status, etag, buffer = getFrame(f"{baseUrl}/kitchen", etag)
+            check("GET it with its ETag gives 304", (status, buffer) == (304, None))
+
+            check("GET an unknown frame gives 404", getFrame(f"{baseUrl}/attic")[0] == 404)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    if failures:
+        print(f"\n{len(failures)} checks of the frame server failed")
+        exit(1)
+
+if __name__ == "__main__":
+    runCheck()
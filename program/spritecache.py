@@ -0,0 +1,108 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+import hashlib
+import io
+import os
+
+from collections import OrderedDict
+from PIL import Image, ImageDraw, PngImagePlugin
+
+
+# Cache of rasterized text. Rendering glyphs with FreeType is a measurable part of drawing a frame on a Pi Zero, and
+# the calendar draws the same strings on every refresh: day numbers, weekday names, "All day", "No events" and
+# event times. The first time a string is drawn, its glyph mask is kept. After that, drawing the string only stamps
+# the mask onto the frame in the requested color, which gives exactly the same pixels as draw.text.
+#
+# Masks are keyed by (text, font, font mode). The color is not part of the key, since the same mask can be stamped
+# in any color. The least recently used masks are dropped once maxEntries is reached. When cacheDir is set, masks
+# are also saved there as PNG files, so a run from cron can reuse the masks of the previous run. They are written
+# through stateStore when one is given (see statestore.py).
+class TextSpriteCache():
+    def __init__(self, fontLoader, maxEntries=512, cacheDir=None, stateStore=None):
+        self.fontLoader = fontLoader
+        self.maxEntries = maxEntries
+        self.cacheDir = cacheDir
+        self.stateStore = stateStore
+        self.sprites = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        if cacheDir:
+            os.makedirs(cacheDir, exist_ok=True)
+
+    # Draws text at xy like draw.text(xy, text, font=fontLoader(fontSpec), fill=fill)
+    def drawText(self, draw, xy, text, fontSpec, fill):
+        mask, offsetX, offsetY = self.getSprite(text, fontSpec, draw.fontmode)
+        if mask is not None:
+            draw.bitmap((xy[0] + offsetX, xy[1] + offsetY), mask, fill=fill)
+
+    def getSprite(self, text, fontSpec, fontMode):
+        key = (text, fontSpec, fontMode)
+        sprite = self.sprites.get(key)
+        if sprite is not None:
+            self.hits += 1
+            self.sprites.move_to_end(key)
+            return sprite
+
+        self.misses += 1
+        sprite = self.loadSprite(key)
+        if sprite is None:
+            sprite = self.renderSprite(text, fontSpec, fontMode)
+            self.saveSprite(key, sprite)
+
+        self.sprites[key] = sprite
+        if len(self.sprites) > self.maxEntries:
+            self.sprites.popitem(last=False)
+
+        return sprite
+
+    # Renders the glyph mask of the text, cropped to its bounding box. Returns (mask, offsetX, offsetY), where the
+    # offset is the position of the mask relative to the xy passed to draw.text.
+    def renderSprite(self, text, fontSpec, fontMode):
+        font = self.fontLoader(fontSpec)
+        left, top, right, bottom = font.getbbox(text, mode=fontMode)
+        if right <= left or bottom <= top:
+            return (None, 0, 0)
+
+        mask = Image.new("L", (right - left, bottom - top), 0)
+        maskDraw = ImageDraw.Draw(mask)
+        maskDraw.fontmode = fontMode
+        maskDraw.text((-left, -top), text, font=font, fill=255)
+        return (mask, left, top)
+
+    def getSpritePath(self, key):
+        keyHash = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.cacheDir, f"{keyHash}.png")
+
+    def loadSprite(self, key):
+        if not self.cacheDir:
+            return None
+
+        try:
+            with Image.open(self.getSpritePath(key)) as spriteImage:
+                # Guard against a hash collision by checking the key stored with the mask
+                if spriteImage.text.get("key") != repr(key):
+                    return None
+                mask = spriteImage.copy()
+                return (mask, int(spriteImage.text["offsetX"]), int(spriteImage.text["offsetY"]))
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def saveSprite(self, key, sprite):
+        mask, offsetX, offsetY = sprite
+        if not self.cacheDir or mask is None:
+            return
+
+        pngInfo = PngImagePlugin.PngInfo()
+        pngInfo.add_text("key", repr(key))
+        pngInfo.add_text("offsetX", str(offsetX))
+        pngInfo.add_text("offsetY", str(offsetY))
+        try:
+            if self.stateStore is None:
+                mask.save(self.getSpritePath(key), pnginfo=pngInfo)
+            else:
+                pngData = io.BytesIO()
+                mask.save(pngData, format="PNG", pnginfo=pngInfo)
+                self.stateStore.write(self.getSpritePath(key), pngData.getvalue())
+        except OSError:
+            pass
@@ -0,0 +1,111 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# Reports how long main.py takes to start, in the style of python -X importtime. Every phase runs in a fresh
+# interpreter, so the numbers are cold start numbers. Save the JSON output for each release and pass it back in with
+# --baseline to see what got slower.
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+programDir = os.path.dirname(os.path.realpath(__file__))
+
+# (phase name, code that runs after "import main")
+phases = [
+    ("import main", "pass"),
+    ("fonts", "[main.getFont(font) for font in (main.eventFont, main.dayFont, main.dayNumFont)]"),
+    ("google libraries", "main.importGoogleLibraries()"),
+    ("display driver", "main.importDisplayDriver()"),
+]
+
+phaseTemplate = """
+import json, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+{code}
+done = time.perf_counter()
+print(json.dumps({{"importMainMs": (imported - start) * 1000, "phaseMs": (done - imported) * 1000}}))
+"""
+
+# Parses the stderr of python -X importtime into {module: cumulative microseconds} for the modules that main.py
+# imports directly. importtime lists nested imports indented, before the module that imported them.
+def parseImportTimes(stderr):
+    importTimes = {}
+    directImports = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3:
+            continue
+
+        moduleName = parts[2].rstrip()
+        depth = (len(moduleName) - len(moduleName.lstrip()) - 1) // 2
+        moduleName = moduleName.strip()
+
+        if depth == 1:
+            directImports[moduleName] = int(parts[1])
+        elif depth == 0:
+            if moduleName == "main":
+                importTimes = directImports
+            directImports = {}
+
+    return importTimes
+
+def runPhase(code):
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", phaseTemplate.format(code=code)],
+                            cwd=programDir, capture_output=True, text=True)
+    if result.returncode != 0:
+        lastLine = result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "unknown error"
+        return {"error": lastLine}
+
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    report["imports"] = parseImportTimes(result.stderr)
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Reports the cold start time of main.py")
+    parser.add_argument("--output", help="write the report as JSON to this file")
+    parser.add_argument("--baseline", help="a report from an earlier run to compare against")
+    parser.add_argument("--top", type=int, default=10, help="number of slowest imports to list")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, "r") as baselineFile:
+            baseline = json.load(baselineFile)
+
+    report = {"python": sys.version.split()[0], "phases": {}}
+    for phaseName, code in phases:
+        phaseReport = runPhase(code)
+        report["phases"][phaseName] = phaseReport
+
+        if "error" in phaseReport:
+            print(f"{phaseName:20} unavailable: {phaseReport['error']}")
+            continue
+
+        phaseMs = phaseReport["importMainMs"] if phaseName == "import main" else phaseReport["phaseMs"]
+        line = f"{phaseName:20} {phaseMs:9.1f} ms"
+
+        baselinePhase = baseline.get("phases", {}).get(phaseName, {})
+        if "phaseMs" in baselinePhase:
+            baselineMs = baselinePhase["importMainMs"] if phaseName == "import main" else baselinePhase["phaseMs"]
+            line += f"  ({phaseMs - baselineMs:+.1f} ms)"
+        print(line)
+
+    mainImports = report["phases"]["import main"].get("imports", {})
+    if mainImports:
+        print("\nSlowest imports when starting main.py:")
+        slowest = sorted(mainImports.items(), key=lambda item: item[1], reverse=True)[:args.top]
+        for moduleName, cumulativeUs in slowest:
+            print(f"  {cumulativeUs / 1000:9.1f} ms  {moduleName}")
+
+    if args.output:
+        with open(args.output, "w") as outputFile:
+            json.dump(report, outputFile, indent=2)
+
+if __name__ == "__main__":
+    main()
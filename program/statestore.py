@@ -0,0 +1,206 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+import hashlib
+import logging
+import os
+import threading
+import time
+
+
+# Writes the files main.py keeps between runs (token.json, last-frame.txt, metrics.json, cached text and panel
+# buffers) with as little wear on the SD card as possible:
+#
+# - A file is only written when its content changed. The digest of every file written or read is remembered, so an
+#   unchanged file is not even read again.
+# - Every write goes to a temporary file that is renamed over the old one, so a power cut never leaves half a file.
+# - Hot files, the ones that change on most runs, are written to hotDir when it is set. hotDir should be on tmpfs,
+#   like /run or /dev/shm, which is memory and not the card. They are copied to stateDir at most every
+#   flushSeconds, and read back from hotDir first. A reboot loses at most flushSeconds of them. Without hotDir, hot
+#   files are kept in memory and written by flush when they are due, or by close when the program ends, so all
+#   the hot files of a run are written together.
+# - Volatile files, like metrics that change on every run and are of no use after a reboot, are hot files that only
+#   live in hotDir and never go to the card. Without hotDir, they are written to stateDir at most every flushSeconds,
+#   even by close.
+#
+# A hot file that is not in stateDir yet is written there right away, so a new token.json is never only in memory.
+# Names are relative to stateDir; absolute paths are written where they point.
+class StateStore():
+    def __init__(self, stateDir, hotDir=None, flushSeconds=3600):
+        self.stateDir = stateDir
+        self.hotDir = hotDir
+        self.flushSeconds = flushSeconds
+        self.lock = threading.Lock()
+        self.digests = {}
+        self.hotNames = set()
+        self.volatileNames = set()
+        self.pending = {}
+        self.flushedTimes = {}
+        self.resetCounters()
+
+        if hotDir:
+            os.makedirs(hotDir, mode=0o700, exist_ok=True)
+
+    def resetCounters(self):
+        self.counters = {"state_bytes_written": 0, "state_files_written": 0, "state_writes_skipped": 0,
+                         "state_hot_bytes_written": 0}
+
+    # Returns the counters since the last call and starts counting again. main.py adds them to the run metrics
+    def takeCounters(self):
+        with self.lock:
+            counters = self.counters
+            self.resetCounters()
+            return counters
+
+    def getPath(self, name):
+        return os.path.join(self.stateDir, name)
+
+    def getHotPath(self, name):
+        if not self.hotDir or os.path.isabs(name):
+            return None
+        return os.path.join(self.hotDir, name)
+
+    # Returns the content of a file as bytes, or None when there is none. The newest copy is returned: a hot
+    # file that is not flushed yet, the copy in hotDir, then the one in stateDir.
+    def read(self, name):
+        with self.lock:
+            if name in self.pending:
+                return self.pending[name]
+
+            for path in (self.getHotPath(name), self.getPath(name)):
+                if path is None:
+                    continue
+                data = readFile(path)
+                if data is not None:
+                    self.digests[path] = getDigest(data)
+                    return data
+
+        return None
+
+    def readText(self, name):
+        data = self.read(name)
+        return data.decode("utf-8") if data is not None else None
+
+    # Writes data (bytes or str) to the file name, unless the file already holds it. Set hot for files that change
+    # on most runs and volatile for files that can be lost on a reboot. Returns True when the content changed.
+    def write(self, name, data, hot=False, volatile=False):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+
+        hot = hot or volatile
+        with self.lock:
+            path = self.getPath(name)
+            hotPath = self.getHotPath(name)
+            if hot:
+                self.hotNames.add(name)
+            if volatile:
+                self.volatileNames.add(name)
+
+            if self.isUnchanged(hotPath if hot and hotPath else path, data, name):
+                self.counters["state_writes_skipped"] += 1
+                return False
+
+            if volatile and hotPath is not None:
+                self.writeHot(hotPath, data)
+            elif not hot or not os.path.exists(path):
+                self.writeState(path, data)
+                self.pending.pop(name, None)
+                if hotPath is not None and os.path.exists(hotPath):
+                    self.writeHot(hotPath, data)
+            elif hotPath is not None:
+                self.writeHot(hotPath, data)
+            else:
+                self.pending[name] = data
+
+        return True
+
+    # Copies the hot files whose copy in stateDir is more than flushSeconds old to stateDir. Set force to copy all
+    # of them now.
+    def flush(self, force=False):
+        with self.lock:
+            nowEpoch = time.time()
+            for name in sorted(self.hotNames):
+                if name in self.volatileNames and self.getHotPath(name) is not None:
+                    continue
+
+                path = self.getPath(name)
+                if not force and nowEpoch - self.getFlushedTime(name, path) < self.flushSeconds:
+                    continue
+
+                data = self.pending.pop(name, None)
+                hotPath = self.getHotPath(name)
+                if data is None and hotPath is not None:
+                    data = readFile(hotPath)
+                if data is not None and not self.isUnchanged(path, data):
+                    self.writeState(path, data)
+                self.flushedTimes[name] = nowEpoch
+
+    # Writes the hot files that are only in memory, before the program ends. Files in hotDir stay there until they
+    # are due, since tmpfs keeps them until the next reboot, and so do volatile files that are not due.
+    def close(self):
+        with self.lock:
+            nowEpoch = time.time()
+            for name, data in list(self.pending.items()):
+                path = self.getPath(name)
+                if name in self.volatileNames and nowEpoch - self.getFlushedTime(name, path) < self.flushSeconds:
+                    continue
+                if not self.isUnchanged(path, data):
+                    self.writeState(path, data)
+            self.pending.clear()
+
+    # When the copy in stateDir was last written. The modification time of the file is used before the first flush,
+    # so runs from cron share the flush interval
+    def getFlushedTime(self, name, path):
+        if name not in self.flushedTimes:
+            try:
+                self.flushedTimes[name] = os.path.getmtime(path)
+            except OSError:
+                return 0
+        return self.flushedTimes[name]
+
+    # Compares data with the file at path. An unknown file is read once; reading does not wear the card.
+    # A file in memory only (see pending) is compared with what is pending.
+    def isUnchanged(self, path, data, name=None):
+        digest = getDigest(data)
+        if name in self.pending:
+            return getDigest(self.pending[name]) == digest
+
+        if path not in self.digests:
+            existing = readFile(path)
+            if existing is None:
+                return False
+            self.digests[path] = getDigest(existing)
+        return self.digests[path] == digest
+
+    def writeState(self, path, data):
+        writeFileAtomically(path, data, sync=True)
+        self.digests[path] = getDigest(data)
+        self.counters["state_bytes_written"] += len(data)
+        self.counters["state_files_written"] += 1
+        logging.debug(f"Wrote {len(data)} bytes to {path}")
+
+    def writeHot(self, path, data):
+        writeFileAtomically(path, data)
+        self.digests[path] = getDigest(data)
+        self.counters["state_hot_bytes_written"] += len(data)
+
+
+def getDigest(data):
+    return hashlib.sha1(data).digest()
+
+def readFile(path):
+    try:
+        with open(path, "rb") as inputFile:
+            return inputFile.read()
+    except FileNotFoundError:
+        return None
+
+# Writes data to a temporary file next to path and renames it over path. With sync, the data is on the card before
+# the rename, so after a power cut there is either the old file or the new one.
+def writeFileAtomically(path, data, sync=False):
+    tempPath = f"{path}.tmp"
+    with open(tempPath, "wb") as tempFile:
+        tempFile.write(data)
+        if sync:
+            tempFile.flush()
+            os.fsync(tempFile.fileno())
+    os.replace(tempPath, path)
@@ -0,0 +1,163 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# Checks the BUSY wait in epdtransfer.py against the Waveshare driver without a panel. The driver is loaded with a
+# stand-in for its epdconfig module that records every command and data byte sent over SPI and plays the BUSY pin
+# like the panel does. A frame is sent through the plain driver and through FastEPD with each way of waiting for
+# BUSY (gpiozero, RPi.GPIO edges, polling). The bytes must be the same; the CPU time shows what the waiting costs.
+#
+# The panel timings are scaled by --scale, 0.1 by default, so a 30 s refresh takes 3 s.
+import argparse
+import importlib
+import importlib.util
+import random
+import sys
+import threading
+import time
+import types
+
+import main
+from epdtransfer import FastEPD
+
+# How long the panel stays busy after a command, in seconds
+busySeconds = {0x04: 0.2, 0x12: 30.0, 0x02: 0.2}
+resetBusySeconds = 0.05
+
+
+# Plays the panel at the other end of the SPI bus and the GPIO pins
+class StandInPanel():
+    RST_PIN = 17
+    DC_PIN = 25
+    CS_PIN = 8
+    BUSY_PIN = 24
+
+    def __init__(self, scale):
+        self.scale = scale
+        self.dcLevel = 0
+        self.csLevel = 1
+        self.resetLevel = 1
+        self.idle = threading.Event()
+        self.idle.set()
+        self.timer = None
+        self.commands = []
+
+    def setBusy(self, seconds):
+        self.idle.clear()
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = threading.Timer(seconds * self.scale, self.idle.set)
+        self.timer.start()
+
+    def write(self, data):
+        data = bytes(data)
+        if self.csLevel != 0:
+            raise AssertionError("SPI write without chip select")
+
+        if self.dcLevel == 0:
+            for command in data:
+                self.commands.append((command, bytearray()))
+                if command in busySeconds:
+                    self.setBusy(busySeconds[command])
+        else:
+            self.commands[-1][1].extend(data)
+
+    def digitalWrite(self, pin, value):
+        if pin == self.DC_PIN:
+            self.dcLevel = value
+        elif pin == self.CS_PIN:
+            self.csLevel = value
+        elif pin == self.RST_PIN:
+            if self.resetLevel == 0 and value == 1:
+                self.setBusy(resetBusySeconds)
+            self.resetLevel = value
+
+    def digitalRead(self, pin):
+        if pin == self.BUSY_PIN:
+            return 1 if self.idle.is_set() else 0
+        return 0
+
+    def delayMs(self, ms):
+        time.sleep(ms / 1000 * self.scale)
+
+    # Returns a stand-in epdconfig module. busyWait is "gpiozero", "edge" or "poll": which way of waiting for the
+    # BUSY pin the module offers
+    def makeEpdConfig(self, busyWait):
+        epdconfig = types.ModuleType("waveshare_epd.epdconfig")
+        epdconfig.RST_PIN = self.RST_PIN
+        epdconfig.DC_PIN = self.DC_PIN
+        epdconfig.CS_PIN = self.CS_PIN
+        epdconfig.BUSY_PIN = self.BUSY_PIN
+        epdconfig.module_init = lambda cleanup=False: 0
+        epdconfig.module_exit = lambda cleanup=False: None
+        epdconfig.digital_write = self.digitalWrite
+        epdconfig.digital_read = self.digitalRead
+        epdconfig.delay_ms = self.delayMs
+        epdconfig.spi_writebyte = self.write
+        epdconfig.spi_writebyte2 = self.write
+
+        if busyWait == "gpiozero":
+            epdconfig.GPIO_BUSY_PIN = types.SimpleNamespace(wait_for_press=self.idle.wait)
+        elif busyWait == "edge":
+            def waitForEdge(pin, edge, timeout=-1):
+                return pin if self.idle.wait(timeout / 1000 if timeout >= 0 else None) else None
+            epdconfig.GPIO = types.SimpleNamespace(RISING=31, wait_for_edge=waitForEdge)
+        return epdconfig
+
+# Imports epd7in3f again, so it picks up epdconfig
+def loadDriver(epdconfig):
+    import waveshare_epd
+
+    sys.modules["waveshare_epd.epdconfig"] = epdconfig
+    waveshare_epd.epdconfig = epdconfig
+    sys.modules.pop("waveshare_epd.epd7in3f", None)
+    return importlib.import_module("waveshare_epd.epd7in3f")
+
+# Sends one frame, from init to sleep. Returns the commands the panel got and the wall and CPU time
+def sendFrame(variant, panelBuffer, scale):
+    panel = StandInPanel(scale)
+    busyWait = "poll" if variant == "driver" else variant.split()[-1]
+    epd7in3f = loadDriver(panel.makeEpdConfig(busyWait))
+
+    epd = epd7in3f.EPD()
+    if variant != "driver":
+        epd = FastEPD(epd, epd7in3f.epdconfig)
+
+    wallStart = time.perf_counter()
+    cpuStart = time.process_time()
+    epd.init()
+    epd.display(panelBuffer)
+    epd.sleep()
+    return panel.commands, time.perf_counter() - wallStart, time.process_time() - cpuStart
+
+def runCheck():
+    parser = argparse.ArgumentParser(description="Checks epdtransfer.py against the Waveshare driver with a "
+                                                 "stand-in panel")
+    parser.add_argument("--scale", type=float, default=0.1, help="scale of the panel timings, 1.0 = real time")
+    args = parser.parse_args()
+
+    if importlib.util.find_spec("waveshare_epd") is None:
+        print(f"The Waveshare driver was not found in {main.libdir}")
+        exit(1)
+
+    # A frame of random panel colors, in the list form epd.getbuffer returns
+    rng = random.Random(1)
+    panelBuffer = [(rng.randrange(7) << 4) | rng.randrange(7) for _ in range(800 * 480 // 2)]
+
+    variants = ["driver", "FastEPD gpiozero", "FastEPD edge", "FastEPD poll"]
+
+    expected = None
+    failed = False
+    print(f"{'variant':24} {'seconds':>8} {'CPU s':>8}  bytes")
+    for variant in variants:
+        commands, wallSeconds, cpuSeconds = sendFrame(variant, panelBuffer, args.scale)
+        if expected is None:
+            expected = commands
+        same = commands == expected
+        failed = failed or not same
+        print(f"{variant:24} {wallSeconds:8.2f} {cpuSeconds:8.3f}  {'same' if same else 'DIFFERENT'}")
+
+    if failed:
+        print("\nFastEPD sent different bytes than the driver")
+        exit(1)
+
+if __name__ == "__main__":
+    runCheck()